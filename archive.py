@@ -0,0 +1,171 @@
+import io
+import os
+import gzip
+import lzma
+import queue
+import zipfile
+import shutil
+import threading
+from lineindex import INDEX_EXT
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+'''
+Streaming of source files from archives and compressed files.
+
+A source file can be a plain text file, a .gz/.xz/.zst compressed text file,
+or a member of a zip archive, written as "archive.zip!member" (members can be
+compressed too). Streams are decompressed by a background thread, a few
+chunks ahead of the reader, so decompression overlaps with filtering.
+'''
+
+MEMBER_SEP = "!"
+COMPRESSED_EXTS = (".gz", ".xz", ".zst")
+ZIP_EXTS = (".zip", ".argosdata")
+
+def split_member(path):
+    """(archive path, member name) of a zip member path, or (path, None)"""
+    if MEMBER_SEP in path:
+        archive, member = path.rsplit(MEMBER_SEP, 1)
+        if archive.lower().endswith(ZIP_EXTS):
+            return archive, member
+    return path, None
+
+def is_stream(path):
+    """Whether path must be read as a stream (it's not a plain file that can be mapped)"""
+    archive, member = split_member(path)
+    return member is not None or path.lower().endswith(COMPRESSED_EXTS)
+
+def container(path):
+    """File that holds path on disk"""
+    return split_member(path)[0]
+
+def list_files(path):
+    """Files of a directory or members of a zip archive (as if it was extracted
+    with extract)"""
+    if os.path.isdir(path):
+        return [f.path for f in os.scandir(path) if f.is_file() and INDEX_EXT not in f.name]
+
+    with zipfile.ZipFile(path, 'r') as zip_ref:
+        names = zip_ref.namelist()
+    subfolders = set(n.split("/")[0] for n in names if "/" in n)
+    files = [n for n in names if "/" not in n]
+    if len(subfolders) == 1:
+        files += [n for n in names if n.count("/") == 1 and not n.endswith("/")]
+    return [f"{path}{MEMBER_SEP}{n}" for n in files if INDEX_EXT not in n]
+
+def _decompress(raw, name):
+    name = name.lower()
+    if name.endswith(".gz"):
+        return gzip.GzipFile(fileobj=raw, mode="rb")
+    if name.endswith(".xz"):
+        return lzma.LZMAFile(raw, mode="rb")
+    if name.endswith(".zst"):
+        if zstandard is None:
+            raise Exception(f"Cannot read {name}: the zstandard package is not installed")
+        return zstandard.ZstdDecompressor().stream_reader(raw)
+    return raw
+
+def _open_raw(path):
+    archive, member = split_member(path)
+    if member is not None:
+        zip_ref = zipfile.ZipFile(archive, 'r')
+        return _decompress(zip_ref.open(member, 'r'), member), zip_ref
+    return _decompress(open(path, "rb"), path), None
+
+class _ThreadedReader(io.RawIOBase):
+    """Raw stream fed by a thread that reads (and decompresses) chunks ahead"""
+
+    def __init__(self, path, chunk_size=4 * 1024 * 1024, max_chunks=8):
+        self.chunks = queue.Queue(max_chunks)
+        self.buffer = b""
+        self.eof = False
+        self.stopped = threading.Event()
+        self.error = None
+        self.thread = threading.Thread(target=self._read, args=(path, chunk_size), daemon=True)
+        self.thread.start()
+
+    def _read(self, path, chunk_size):
+        try:
+            f, zip_ref = _open_raw(path)
+            try:
+                while not self.stopped.is_set():
+                    chunk = f.read(chunk_size)
+                    self._put(chunk)
+                    if not chunk:
+                        break
+            finally:
+                f.close()
+                if zip_ref is not None:
+                    zip_ref.close()
+        except BaseException as e:
+            self.error = e
+            self._put(b"")
+
+    def _put(self, chunk):
+        while not self.stopped.is_set():
+            try:
+                self.chunks.put(chunk, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while len(self.buffer) == 0:
+            if self.eof:
+                return 0
+            self.buffer = self.chunks.get()
+            if not self.buffer:
+                self.eof = True
+                if self.error is not None:
+                    raise self.error
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        self.stopped.set()
+        super().close()
+
+def open_stream(path):
+    """Binary file object of a (possibly compressed or archived) file,
+    decompressed by a background thread"""
+    return io.BufferedReader(_ThreadedReader(path), buffer_size=1024 * 1024)
+
+def count_lines(path):
+    with open_stream(path) as f:
+        return sum(chunk.count(b"\n") for chunk in iter(lambda: f.read(16 * 1024 * 1024), b""))
+
+def size(path):
+    """Size of the (uncompressed) contents of a file. For .gz/.xz/.zst
+    files it's only an estimate, since their uncompressed size isn't stored."""
+    archive, member = split_member(path)
+    if member is not None:
+        with zipfile.ZipFile(archive, 'r') as zip_ref:
+            compressed = member.lower().endswith(COMPRESSED_EXTS)
+            info = zip_ref.getinfo(member)
+            return info.file_size * 4 if compressed else info.file_size
+    if path.lower().endswith(COMPRESSED_EXTS):
+        return os.path.getsize(path) * 4
+    return os.path.getsize(path)
+
+def extract(path, out_dir):
+    """Extract a zip archive, moving the files of a single top-level folder up"""
+    os.makedirs(out_dir, exist_ok=True)
+    with zipfile.ZipFile(path, 'r') as zip_ref:
+        zip_ref.extractall(out_dir)
+
+    subfolders = [f.path for f in os.scandir(out_dir) if f.is_dir()]
+    if len(subfolders) == 1:
+        # Move files from subfolder
+        for f in [f.path for f in os.scandir(subfolders[0]) if f.is_file()]:
+            shutil.move(f, out_dir)
+
+        shutil.rmtree(subfolders[0])
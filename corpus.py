@@ -0,0 +1,76 @@
+import os
+import json
+import shutil
+
+'''
+On-disk corpus of aligned (source, target) pairs, which holds the whole merged
+corpus between the stages of merging when near-duplicates are removed.
+
+A corpus is a directory with a blob of the UTF-8 lines of each side, newline
+terminated (src.bin, tgt.bin: a blob is also a plain text file, which the
+deduplication passes and the shuffle read directly), and meta.json, which holds
+the number of pairs. It is written to a temporary directory that replaces the
+corpus once complete.
+'''
+
+SIDES = ("src", "tgt")
+
+def blob_path(path, side):
+    return os.path.join(path, f"{side}.bin")
+
+class CorpusWriter:
+    """Writes a corpus to path (replacing it on close)"""
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp = path + ".tmp"
+        shutil.rmtree(self.tmp, ignore_errors=True)
+        os.makedirs(self.tmp)
+        self.count = 0
+        self.blobs = [open(blob_path(self.tmp, side), "wb") for side in SIDES]
+
+    def add(self, src_lines, tgt_lines):
+        """Add pairs of lines (bytes, without newlines)"""
+        for blob, lines in zip(self.blobs, (src_lines, tgt_lines)):
+            if len(lines) > 0:
+                blob.write(b"\n".join(lines) + b"\n")
+        self.count += len(src_lines)
+
+    def write(self, src_bytes, tgt_bytes):
+        """Add a batch of newline terminated source and target lines
+        (lines are stripped)"""
+        self.add([l.strip() for l in src_bytes.split(b"\n")[:-1]],
+                 [l.strip() for l in tgt_bytes.split(b"\n")[:-1]])
+
+    def close(self):
+        """Finish writing the corpus. Returns the Corpus."""
+        for f in self.blobs:
+            f.close()
+        with open(os.path.join(self.tmp, "meta.json"), "w", encoding="utf-8") as f:
+            f.write(json.dumps({'count': self.count}))
+        shutil.rmtree(self.path, ignore_errors=True)
+        os.rename(self.tmp, self.path)
+        return Corpus(self.path)
+
+    def discard(self):
+        for f in self.blobs:
+            f.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+class Corpus:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            self.count = json.loads(f.read())['count']
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def src_path(self):
+        """Path of the source lines, as a text file"""
+        return blob_path(self.path, "src")
+
+    @property
+    def tgt_path(self):
+        return blob_path(self.path, "tgt")
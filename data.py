@@ -1,17 +1,28 @@
 import random
 import os
 import hashlib
-from concurrent.futures import ThreadPoolExecutor
+import json
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
 import mmap
+import queue
+import shutil
 import time
-from collections import deque
-import threading
+import itertools
+import contextlib
 from net import download
 import filters as filter_funcs
 import transforms as transform_funcs
 import augmenters as augment_funcs
-from fastshuffle import file_shuffle_sample
-from io import StringIO
+import dedup
+import lineindex
+import archive
+from profiling import Profile, merge_profiles, source_report, write_report, format_table
+from shuffle import BucketShuffle, num_buckets, shuffle_split
+from corpus import CorpusWriter
+
+# Sources larger than this are split into shards filtered by separate workers
+SHARD_SIZE = 64 * 1024 * 1024
 
 # The list is ordered according to lang_codes found on OPUS
 # Some dialects and scripts listed in flores200 have not been mapped due to lack of resource on OPUS
@@ -213,32 +224,64 @@ nllb_langs = { #Name found on opus as comments, if [] other known alias, () seve
 }
 
 def count_lines(file):
-    def blocks(files, size=65536):
-        while True:
-            b = files.read(size)
-            if not b: break
-            yield b
+    if archive.is_stream(file):
+        return archive.count_lines(file)
+    return lineindex.load(file).count
+
+def file_fingerprint(path):
+    # Archive members change with their archive
+    st = os.stat(archive.container(path))
+    return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+
+_code_hash = None
 
-    with open(file, "r",encoding="utf-8",errors='ignore') as f:
-        return sum(bl.count("\n") for bl in blocks(f))
+def code_hash():
+    """Hash of the filter, transform and augmenter implementations"""
+    global _code_hash
+    if _code_hash is None:
+        md5 = hashlib.md5()
+        for module in [filter_funcs, transform_funcs, augment_funcs]:
+            with open(module.__file__, "rb") as f:
+                md5.update(f.read())
+        _code_hash = md5.hexdigest()
+    return _code_hash
 
+def source_key(source):
+    """Key of the filtered output of a source: changes when the source files,
+    the filter/transform/augmenter chain or its arguments change"""
+    key = {
+        'source': file_fingerprint(source['source']),
+        'target': file_fingerprint(source['target']),
+        'from': source['from'],
+        'to': source['to'],
+        'filters': source['filters'],
+        'transforms': source['transforms'],
+        'augmenters': source['augmenters'],
+        'weight': source['weight'],
+        'code': code_hash(),
+    }
+    return hashlib.md5(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
 
-def sources_changed(sources, out_dir):
+def merge_key(sources, options={}):
+    keys = [source_key(sources[k]) for k in sources]
+    return hashlib.md5(json.dumps([keys, options], sort_keys=True).encode('utf-8')).hexdigest()
+
+def sources_changed(sources, out_dir, options={}):
     merge_hash_file = os.path.join(out_dir, "merge-hash.txt")
-    sources_hash = hashlib.md5("|".join(sorted([k for k in sources])).encode('utf-8')).hexdigest()
 
     if os.path.isfile(merge_hash_file):
         with open(merge_hash_file, "r", encoding="utf-8") as f:
             merge_hash = f.readline().strip()
-            if merge_hash == sources_hash:
+            if merge_hash == merge_key(sources, options):
                 print("No changes in sources")
                 return False
 
-    with open(merge_hash_file, "w", encoding="utf-8") as f:
-        f.write(sources_hash)
-
     return True
 
+def save_merge_hash(sources, out_dir, options={}):
+    with open(os.path.join(out_dir, "merge-hash.txt"), "w", encoding="utf-8") as f:
+        f.write(merge_key(sources, options))
+
 def get_flores_dataset_path(dataset="dev"):
     # Swap the definitions to allow looking for translation memoirs
     current_dir = os.path.dirname(__file__)
@@ -298,11 +341,479 @@ def extract_flores_val(src_code, tgt_code, out_dir, dataset="dev"):
             f.write("\n".join(tgt_val) + "\n")
         print(f"Wrote {tgt_f}")
     
-def merge_shuffle(sources, out_dir, max_eval_sentences=5000, remove_duplicates=True):
-    if not sources_changed(sources, out_dir):
+def get_fasttext_path():
+    return os.path.join(os.path.dirname(__file__),"utils","fasttext","lid.176.bin")
+
+# fasttext models are loaded once per process (and shared by its threads)
+_fasttext_models = {}
+
+def load_fasttext(fasttext_path):
+    if fasttext_path not in _fasttext_models:
+        import fasttext
+        _fasttext_models[fasttext_path] = fasttext.load_model(fasttext_path)
+    return _fasttext_models[fasttext_path]
+
+def get_filter(name, kwargs={}):
+    """Filter function of a pair, with a batch attribute taking lists of
+    sources and targets (per-line filters are wrapped)"""
+    func = getattr(filter_funcs, name)
+    lam = lambda src, tgt: func(src, tgt, **kwargs)
+    lam.__name__ = name
+    lam.__args__ = kwargs
+    if hasattr(func, "batch"):
+        lam.batch = lambda srcs, tgts: func.batch(srcs, tgts, **kwargs)
+    else:
+        lam.batch = lambda srcs, tgts: [func(src, tgt, **kwargs) for src, tgt in zip(srcs, tgts)]
+    return lam
+
+def get_filters(source, flmodel=None):
+    src_chset = nllb_langs[source['from']][-4:]
+    tgt_chset = nllb_langs[source['to']][-4:]
+    filters = []
+
+    for f in source['filters']:
+        if isinstance(f, dict):
+            name = list(f.keys())[0]
+            kwargs = dict(f[name])
+            if name == 'limit_latin_chars':
+                kwargs = {"s_chset": src_chset, "t_chset": tgt_chset, **kwargs}
+            elif name == 'fast_lang':
+                kwargs = {"s_lang": source['from'], "t_lang": source['to'], "model": flmodel, **kwargs}
+            filters.append(get_filter(name, kwargs))
+        elif f == "fast_lang":
+            filters.append(get_filter("fast_lang", {"s_lang": source['from'], "t_lang": source['to'], "model": flmodel}))
+        else:
+            filters.append(get_filter(f))
+
+    return filters
+
+def get_transforms(source):
+    transforms = []
+    for t in source['transforms']:
+        if isinstance(t, dict):
+            func_name = list(t.keys())[0]
+            def get_func(name):
+                kwargs = dict(t[name])
+                func = getattr(transform_funcs, name)
+                lam = lambda src, tgt: func(src, tgt, **kwargs)
+                lam.__name__ = name
+                return lam
+            transforms.append(get_func(func_name))
+        else:
+            transforms.append(getattr(transform_funcs, t))
+    return transforms
+
+def get_augmenters(source):
+    augmenters = []
+    for a in source['augmenters']:
+        if isinstance(a, dict):
+            func_name = list(a.keys())[0]
+            def get_func(name):
+                kwargs = dict(a[name])
+                # Only used by augmenters applied on the fly (see onmt_tools.py)
+                kwargs.pop('probability', None)
+                func = getattr(augment_funcs, name)
+                lam = lambda src, tgt: func(src, tgt, **kwargs)
+                lam.__name__ = name
+                return lam
+            augmenters.append(get_func(func_name))
+        else:
+            augmenters.append(getattr(augment_funcs, a))
+    return augmenters
+
+def get_line_range(source):
+    """Lines [first, last) of a source selected by the top/excerpt filters
+    (last is None when the source is read until the end)"""
+    begin_at = None
+    stop_at = None
+    line_count = None
+
+    for f in source['filters']:
+        name = list(f.keys())[0] if isinstance(f, dict) else f
+        kwargs = f[name] if isinstance(f, dict) else {}
+
+        if name == "top":
+            line_count = count_lines(source['source'])
+            print(f"Line count: {line_count}")
+            stop_at = int((kwargs.get("percent", 100) / 100) * line_count)
+            print(f"Stop at: {stop_at}")
+
+        if name == "excerpt":
+            line_count = count_lines(source['source'])
+            print(f"Line count: {line_count}")
+            begin_at = int((kwargs.get("top_percentile", 100) / 100) * line_count)
+            print(f"Excerpt will begin at line: {begin_at}")
+            stop_at = int((kwargs.get("bottom_percentile", 100) / 100) * line_count)
+            print(f"Excerpt will end at line: {stop_at}")
+
+    # Line numbers in the messages above start at 1 and stop_at is inclusive
+    first = max(begin_at - 1, 0) if begin_at is not None else 0
+    last = stop_at + 1 if stop_at is not None else None
+    return first, last
+
+def shard_source(source, shards):
+    """Split a source into (at most) N shards of aligned (src_range, tgt_range)
+    byte ranges. Split points are snapped to the end of a line in the source file,
+    then the offsets of the same lines are looked up in the target file.
+    Streamed sources (see archive.py) cannot be split and are read as a whole."""
+    if archive.is_stream(source['source']) or archive.is_stream(source['target']):
+        return [(None, None)]
+
+    first, last = get_line_range(source)
+    src_size = os.path.getsize(source['source'])
+    tgt_size = os.path.getsize(source['target'])
+
+    if shards <= 1 and first == 0 and last is None:
+        return [((0, src_size), (0, tgt_size))]
+    if src_size == 0 or tgt_size == 0:
+        return [((0, 0), (0, 0))]
+
+    src_index = lineindex.load(source['source'])
+    tgt_index = lineindex.load(source['target'])
+
+    begin = src_index.line_offset(first)
+    end = src_index.line_offset(last) if last is not None else src_size
+
+    # Split points at roughly equal byte intervals, snapped to the next line
+    cuts = []
+    cut_lines = []
+    for i in range(1, shards):
+        nxt = src_index.next_line(begin + (end - begin) * i // shards)
+        if nxt is None or nxt[1] >= end:
+            break
+        if len(cuts) == 0 or nxt[1] > cuts[-1]:
+            cut_lines.append(nxt[0])
+            cuts.append(nxt[1])
+
+    src_points = [begin] + cuts + [end]
+    tgt_points = tgt_index.line_offsets([first] + cut_lines + ([last] if last is not None else []))
+    if last is None:
+        tgt_points.append(tgt_size)
+
+    return [((src_points[i], src_points[i + 1]), (tgt_points[i], tgt_points[i + 1])) for i in range(len(src_points) - 1)]
+
+def mapped_lines(mm, byte_range=None):
+    """Lines of a memory-mapped file within a byte range"""
+    begin, end = byte_range if byte_range is not None else (0, len(mm))
+    mm.seek(begin)
+    pos = begin
+    while pos < end:
+        line = mm.readline()
+        if len(line) == 0:
+            break
+        pos += len(line)
+        yield line
+
+def process_source(source, emit, flmodel=None, src_range=None, tgt_range=None, batch_size=4 * 1024 * 1024, filter_batch_size=1000,
+                   adaptive_filters=False, filter_sample_size=10000, profile=None):
+    """Filter, transform and augment a source (or the lines of a source within the
+    src_range/tgt_range byte ranges), calling emit(src_bytes, tgt_bytes)
+    for every batch of newline terminated lines (of about batch_size characters).
+    Filters are applied to batches of filter_batch_size pairs.
+    With adaptive_filters, every filter is run on the first filter_sample_size pairs
+    to measure its cost and reject rate, then filters are reordered so that
+    cheap filters that reject many pairs run first. Rejected pairs are counted
+    against the first filter of the config that rejects them, whatever the order.
+    Every stage is timed once per batch and recorded in profile (a profiling.Profile).
+    Returns a (count, augmented, filtered) tuple."""
+    stream = archive.is_stream(source['source']) or archive.is_stream(source['target'])
+    if not stream and (os.path.getsize(source['source']) == 0 or os.path.getsize(source['target']) == 0):
+        return 0, 0, {}
+
+    if profile is None:
+        profile = Profile()
+    started = time.perf_counter()
+
+    filters = get_filters(source, flmodel)
+    transforms = get_transforms(source)
+    augmenters = get_augmenters(source)
+
+    if src_range is None:
+        print(f"Reading {source['source']} - {source['target']}")
+    else:
+        print(f"Reading {source['source']} - {source['target']} [{src_range[0]}:{src_range[1]}]")
+    filtered = {}
+    count = 0
+    augmented = 0
+
+    # Config indices of the filters, in the order they run
+    order = list(range(len(filters)))
+    sampled = 0 if adaptive_filters and len(filters) > 1 else None
+    filter_cost = [0.0] * len(filters)
+    filter_rejects = [0] * len(filters)
+
+    src_batch = []
+    tgt_batch = []
+    batch_len = 0
+
+    def flush():
+        nonlocal batch_len
+        start = time.perf_counter()
+        emit("".join(src_batch).encode("utf-8"), "".join(tgt_batch).encode("utf-8"))
+        profile.record("write", "emit", time.perf_counter() - start, len(src_batch))
+        src_batch.clear()
+        tgt_batch.clear()
+        batch_len = 0
+
+    with contextlib.ExitStack() as stack:
+        if stream:
+            # Decompressed by background threads; the line range of
+            # the top/excerpt filters is applied while reading
+            src_fp = stack.enter_context(archive.open_stream(source['source']))
+            tgt_fp = stack.enter_context(archive.open_stream(source['target']))
+            first, last = get_line_range(source)
+            reader = itertools.islice(zip(src_fp, tgt_fp), first, last)
+        else:
+            src_fp = stack.enter_context(open(source['source'], "rb"))
+            tgt_fp = stack.enter_context(open(source['target'], "rb"))
+            src_mm = mmap.mmap(src_fp.fileno(), 0, access=mmap.ACCESS_READ)
+            tgt_mm = mmap.mmap(tgt_fp.fileno(), 0, access=mmap.ACCESS_READ)
+            stack.callback(src_mm.close)
+            stack.callback(tgt_mm.close)
+            reader = zip(mapped_lines(src_mm, src_range), mapped_lines(tgt_mm, tgt_range))
+
+        while True:
+            start = time.perf_counter()
+            read = 0
+            srcs = []
+            tgts = []
+            for src_line, tgt_line in itertools.islice(reader, filter_batch_size):
+                read += 1
+
+                line_s = src_line.decode("utf-8").strip()
+                line_t = tgt_line.decode("utf-8").strip()
+
+                # Skip empty
+                if len(line_s) == 0 or len(line_t) == 0:
+                    continue
+
+                srcs.append(line_s)
+                tgts.append(line_t)
+            if read == 0:
+                break
+            profile.record("read", "lines", time.perf_counter() - start, read)
+            profile.lines += read
+
+            if sampled is not None:
+                # Run every filter on every pair, but count rejects in chain order
+                removes = []
+                for fi, f in enumerate(filters):
+                    start = time.perf_counter()
+                    remove = list(f.batch(srcs, tgts))
+                    elapsed = time.perf_counter() - start
+                    rejected = sum(1 for r in remove if r)
+                    filter_cost[fi] += elapsed
+                    filter_rejects[fi] += rejected
+                    profile.record("filter", f.__name__, elapsed, len(srcs), rejected)
+                    removes.append(remove)
+
+                kept = []
+                for i in range(len(srcs)):
+                    for f, remove in zip(filters, removes):
+                        if remove[i]:
+                            filtered[f.__name__] = filtered.get(f.__name__, 0) + 1
+                            break
+                    else:
+                        kept.append(i)
+
+                sampled += len(srcs)
+                if sampled >= filter_sample_size:
+                    order = reorder_filters(filter_cost, filter_rejects)
+                    print(f"Filter order for {source['source']}: {', '.join(filters[fi].__name__ for fi in order)}")
+                    sampled = None
+            else:
+                # Each filter only sees the pairs kept by the previous ones
+                kept = range(len(srcs))
+                for pos, fi in enumerate(order):
+                    if len(kept) == 0:
+                        break
+                    f = filters[fi]
+                    start = time.perf_counter()
+                    remove = f.batch([srcs[i] for i in kept], [tgts[i] for i in kept])
+                    checked = len(kept)
+                    rejected = [i for i, r in zip(kept, remove) if r]
+                    kept = [i for i, r in zip(kept, remove) if not r]
+                    profile.record("filter", f.__name__, time.perf_counter() - start, checked, len(rejected))
+
+                    # Filters that come first in the config but run later could
+                    # also reject these pairs: count them against the first one
+                    for fj in sorted(fj for fj in order[pos + 1:] if fj < fi):
+                        if len(rejected) == 0:
+                            break
+                        remove = filters[fj].batch([srcs[i] for i in rejected], [tgts[i] for i in rejected])
+                        earlier = sum(1 for r in remove if r)
+                        if earlier > 0:
+                            filtered[filters[fj].__name__] = filtered.get(filters[fj].__name__, 0) + earlier
+                        rejected = [i for i, r in zip(rejected, remove) if not r]
+                    if len(rejected) > 0:
+                        filtered[f.__name__] = filtered.get(f.__name__, 0) + len(rejected)
+
+            # Transforms and augmenters are applied one stage at a time,
+            # so that each stage is timed once per batch
+            pairs = [(srcs[i], tgts[i]) for i in kept]
+            count += len(pairs)
+            for t in transforms:
+                start = time.perf_counter()
+                pairs = [t(line_s, line_t) for line_s, line_t in pairs]
+                profile.record("transform", t.__name__, time.perf_counter() - start, len(pairs))
+
+            augmented_pairs = []
+            for a in augmenters:
+                start = time.perf_counter()
+                augmented_pairs.append([a(line_s, line_t) for line_s, line_t in pairs])
+                profile.record("augmenter", a.__name__, time.perf_counter() - start, len(pairs))
+
+            for i, (line_s, line_t) in enumerate(pairs):
+                src_batch.append(line_s + '\n')
+                tgt_batch.append(line_t + '\n')
+                batch_len += len(line_s) + len(line_t)
+
+                for a_out in augmented_pairs:
+                    for a_src, a_tgt in a_out[i]:
+                        src_batch.append(a_src + '\n')
+                        tgt_batch.append(a_tgt + '\n')
+                        batch_len += len(a_src) + len(a_tgt)
+                        augmented += 1
+
+                if batch_len >= batch_size:
+                    flush()
+
+    if len(src_batch) > 0:
+        flush()
+
+    profile.seconds += time.perf_counter() - started
+    return count, augmented, filtered
+
+def reorder_filters(cost, rejects):
+    """Indices of filters by increasing cost per rejected pair, which minimizes
+    the expected cost of the chain when filters are independent.
+    Filters that rejected nothing go last, in their original order."""
+    def rank(fi):
+        if rejects[fi] == 0:
+            return (1, fi)
+        return (0, cost[fi] / rejects[fi])
+    return sorted(range(len(cost)), key=rank)
+
+class MergeWriter:
+    """Writes the batches of several tasks to out (a BucketShuffle or a CorpusWriter), in task order.
+    Batches of a task that is ahead of the one currently being written
+    are spooled to disk until its turn comes, so that the output does not
+    depend on which worker finishes first.
+    The output of a task can also be copied to other files (tee), or read
+    from existing files (copy)."""
+
+    def __init__(self, out, spool_dir, on_written=None):
+        self.spool_dir = spool_dir
+        self.on_written = on_written
+        self.current = 0
+        self.finished = set()
+        self.spools = {}
+        self.inputs = {}
+        self.tees = {}
+        self.out = out
+
+    def _spool_paths(self, idx):
+        return (os.path.join(self.spool_dir, f".merge-{idx}-src.txt"),
+                os.path.join(self.spool_dir, f".merge-{idx}-tgt.txt"))
+
+    def _write(self, idx, src_bytes, tgt_bytes):
+        self.out.write(src_bytes, tgt_bytes)
+        if idx in self.tees:
+            self.tees[idx][0].write(src_bytes)
+            self.tees[idx][1].write(tgt_bytes)
+
+    def tee(self, idx, src_fp, tgt_fp):
+        self.tees[idx] = (src_fp, tgt_fp)
+
+    def copy(self, idx, src_path, tgt_path):
+        self.inputs[idx] = (src_path, tgt_path)
+        if idx == self.current:
+            self._write_pending(idx)
+        self.done(idx)
+
+    def _write_pending(self, idx):
+        """Write the spooled (or existing) content of a task that just became current"""
+        if idx in self.spools:
+            for sp in self.spools.pop(idx):
+                sp.close()
+            paths = self._spool_paths(idx)
+            delete = True
+        elif idx in self.inputs:
+            paths = self.inputs.pop(idx)
+            delete = False
+        else:
+            return
+
+        with open(paths[0], "rb") as src, open(paths[1], "rb") as tgt:
+            while True:
+                src_lines = src.readlines(16 * 1024 * 1024)
+                if len(src_lines) == 0:
+                    break
+                tgt_lines = list(itertools.islice(tgt, len(src_lines)))
+                self._write(idx, b"".join(src_lines), b"".join(tgt_lines))
+        if delete:
+            for p in paths:
+                os.unlink(p)
+
+    def write(self, idx, src_bytes, tgt_bytes):
+        if idx == self.current:
+            self._write(idx, src_bytes, tgt_bytes)
+        else:
+            if idx not in self.spools:
+                self.spools[idx] = tuple(open(p, "wb") for p in self._spool_paths(idx))
+            src_sp, tgt_sp = self.spools[idx]
+            src_sp.write(src_bytes)
+            tgt_sp.write(tgt_bytes)
+
+    def done(self, idx):
+        self.finished.add(idx)
+        while self.current in self.finished:
+            self.tees.pop(self.current, None)
+            if self.on_written is not None:
+                self.on_written(self.current)
+            self.current += 1
+            self._write_pending(self.current)
+
+    def close(self):
+        for idx in list(self.spools):
+            for sp, path in zip(self.spools.pop(idx), self._spool_paths(idx)):
+                sp.close()
+                os.unlink(path)
+
+# Set in each merge worker process by _init_merge_worker
+_merge_queue = None
+_merge_fasttext_path = None
+
+def _init_merge_worker(lines, fasttext_path):
+    global _merge_queue, _merge_fasttext_path
+    _merge_queue = lines
+    _merge_fasttext_path = fasttext_path
+
+def _merge_worker(idx, source, src_range, tgt_range, options):
+    flmodel = load_fasttext(_merge_fasttext_path) if _merge_fasttext_path is not None else None
+    stats = None
+    try:
+        profile = Profile()
+        stats = process_source(source, lambda s, t: _merge_queue.put((idx, s, t)), flmodel, src_range, tgt_range, profile=profile, **options)
+        stats += (profile.to_dict(),)
+    finally:
+        _merge_queue.put((idx, None, stats))
+
+def merge_shuffle(sources, out_dir, max_eval_sentences=5000, remove_duplicates=True, workers=None, use_processes=True, batch_size=4 * 1024 * 1024, max_queued_batches=64, shard_size=SHARD_SIZE,
+                  dedup_key="pair", dedup_bits=64, dedup_memory_limit=1024 * 1024 * 1024,
+                  remove_near_duplicates=False, adaptive_filters=False, shuffle_seed=None, shuffle_memory_limit=1024 * 1024 * 1024,
+                  force=False):
+    options = {
+        'max_eval_sentences': max_eval_sentences,
+        'remove_duplicates': remove_duplicates,
+        'dedup_key': dedup_key,
+        'dedup_bits': dedup_bits,
+        'remove_near_duplicates': remove_near_duplicates,
+        'shuffle_seed': shuffle_seed,
+    }
+    if not force and not sources_changed(sources, out_dir, options):
         return False
 
-    lines = deque()
     total_count = 0
 
     src_train = os.path.join(out_dir, "src-train.txt")
@@ -314,232 +825,205 @@ def merge_shuffle(sources, out_dir, max_eval_sentences=5000, remove_duplicates=T
     fasttext_path = None
     for s in sources:
         for f in sources[s]['filters']:
-            if f == "fast_lang":
-                fasttext_path = os.path.join(os.path.dirname(__file__),"utils","fasttext","lid.176.bin")
-    if fasttext_path is not None:
-        import fasttext
-        flmodel = fasttext.load_model(fasttext_path)
+            if f == "fast_lang" or (isinstance(f, dict) and "fast_lang" in f):
+                fasttext_path = get_fasttext_path()
 
-    def process_source(k):
-        nonlocal total_count
-        source = sources[k]['source']
-        src_lang = sources[k]['from']
-        src_chset = nllb_langs[src_lang][-4:]
-        target = sources[k]['target']
-        tgt_lang = sources[k]['to']
-        tgt_chset = nllb_langs[tgt_lang][-4:]
-        if sources[k]['weight'] is not None:
-            return
-        
-        filters = []
-        transforms = []
-        augmenters = []
-
-        for f in sources[k]['filters']:
-            if isinstance(f, dict):
-                func_name = list(f.keys())[0]
-                def get_func(name):
-                    kwargs = dict(f[name])
-                    func = getattr(filter_funcs, name)
-                    if name == 'limit_latin_chars':
-                        kwargs = {"s_chset": src_chset, "t_chset": tgt_chset, **kwargs}
-                    lam = lambda src, tgt: func(src, tgt, **kwargs)
-                    lam.__name__ = name
-                    lam.__args__ = kwargs
-                    return lam 
-                filters.append(get_func(func_name))
-            elif f == "fast_lang":
-                def fastlang_func():
-                    kwargs = {"s_lang": src_lang, "t_lang": tgt_lang, "model": flmodel}
-                    func = getattr(filter_funcs, "fast_lang")
-                    lam = lambda src, tgt: func(src, tgt, **kwargs)
-                    lam.__name__ = "fast_lang"
-                    lam.__args__ = kwargs
-                    return lam
-                filters.append(fastlang_func())
-            else:
-                filters.append(getattr(filter_funcs, f))
-        
-        for t in sources[k]['transforms']:
-            if isinstance(t, dict):
-                func_name = list(t.keys())[0]
-                def get_func(name):
-                    kwargs = dict(t[name])
-                    func = getattr(transform_funcs, name)
-                    lam = lambda src, tgt: func(src, tgt, **kwargs)
-                    lam.__name__ = name
-                    return lam
-                transforms.append(get_func(func_name))
-            else:
-                transforms.append(getattr(transform_funcs, t))
-
-        for a in sources[k]['augmenters']:
-            if isinstance(a, dict):
-                func_name = list(a.keys())[0]
-                def get_func(name):
-                    kwargs = dict(a[name])
-                    func = getattr(augment_funcs, name)
-                    lam = lambda src, tgt: func(src, tgt, **kwargs)
-                    lam.__name__ = name
-                    return lam
-                augmenters.append(get_func(func_name))
-            else:
-                augmenters.append(getattr(augment_funcs, a))
-
-
-        print(f"Reading {source} - {target}")
-        filtered = {}
-        count = 0
-        augmented = 0
-        line_no = 0
-        begin_at = None
-        stop_at = None
-        line_count = None
-
-        for f in filters:
-            if f.__name__ == "top":
-                line_count = count_lines(source)
-                print(f"Line count: {line_count}")
-                stop_at = int((f.__args__.get("percent", 100) / 100) * line_count)
-                print(f"Stop at: {stop_at}")
-
-            if f.__name__ == "excerpt":
-                line_count = count_lines(source)
-                print(f"Line count: {line_count}")
-                begin_at = int((f.__args__.get("top_percentile", 100) / 100) * line_count)
-                print(f"Excerpt will begin at line: {begin_at}")
-                stop_at = int((f.__args__.get("bottom_percentile", 100) / 100) * line_count)
-                print(f"Excerpt will end at line: {stop_at}")
-
-        with open(source, "r+b") as src_fp, \
-             open(target, "r+b") as tgt_fp:
-            src_mm = mmap.mmap(src_fp.fileno(), 0)
-            tgt_mm = mmap.mmap(tgt_fp.fileno(), 0)
-            src_it = iter(src_mm.readline, b"")
-            tgt_it = iter(tgt_mm.readline, b"")
-
-            for src_line in src_it:
-                #Exit after "stop_at" line if excerpt or top filter on
-                if stop_at is not None and line_no > stop_at:
-                    print(f"Finished collecting before line {line_no}")
-                    break
+    # Weighted sources are used as-is
+    merge_sources = [sources[k] for k in sources if sources[k]['weight'] is None]
 
-                line_s = src_line.decode("utf-8").strip()
-                line_t = next(tgt_it).decode("utf-8").strip()
-                
-                #Start counting every line ('count' excludes filtered lines)
-                line_no += 1
-                
-                # Skip lines until begin_at if excerpt filter on
-                if begin_at is not None and line_no < begin_at:
-                    continue
-                
-                # Skip empty
-                if len(line_s) == 0 or len(line_t) == 0:
-                    continue
-                
-                skip = False
-                for f in filters:
-                    if f(line_s, line_t):
-                        skip = True
-                        filtered[f.__name__] = filtered.get(f.__name__, 0) + 1
-                        break
-                
-                if skip:
-                    continue
+    # The filtered output of each source is cached, and only reprocessed
+    # when its files or its filter/transform/augmenter chain change
+    cache_dir = os.path.join(out_dir, "sources")
+    os.makedirs(cache_dir, exist_ok=True)
+    keys = [source_key(s) for s in merge_sources]
+    def cache_paths(key):
+        return (os.path.join(cache_dir, f"{key}-src.txt"),
+                os.path.join(cache_dir, f"{key}-tgt.txt"),
+                os.path.join(cache_dir, f"{key}.json"))
 
-                count += 1
+    for f in os.listdir(cache_dir):
+        if f[:32] not in keys:
+            os.unlink(os.path.join(cache_dir, f))
 
-                for t in transforms:
-                    line_s, line_t = t(line_s, line_t)
-                
-                lines.append((line_s + '\n', line_t + '\n'))
+    cached = {}
+    for i, key in enumerate(keys):
+        src_cache, tgt_cache, stats_cache = cache_paths(key)
+        if os.path.isfile(stats_cache) and os.path.isfile(src_cache) and os.path.isfile(tgt_cache):
+            with open(stats_cache, "r", encoding="utf-8") as f:
+                cached[i] = tuple(json.loads(f.read()))
 
-                for a in augmenters:
-                    for a_src, a_tgt in a(line_s, line_t):
-                        lines.append((a_src + '\n', a_tgt + '\n'))
-                        augmented += 1
-            src_mm.close()
-            tgt_mm.close()
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # Large sources are split in shards, so that they can be filtered by several workers.
+    # Shards are written in line order.
+    tasks = []
+    for i, s in enumerate(merge_sources):
+        if i in cached:
+            tasks.append((i, None, None))
+            continue
+
+        shards = 1
+        if workers > 1:
+            shards = max(1, min(workers, archive.size(s['source']) // shard_size))
+        for src_range, tgt_range in shard_source(s, shards):
+            tasks.append((i, src_range, tgt_range))
+    process_tasks = [(t, i, src_range, tgt_range) for t, (i, src_range, tgt_range) in enumerate(tasks) if i not in cached]
+    workers = max(1, min(workers, len(process_tasks)))
+
+    last_task = {}
+    source_stats = [(0, 0, {}) for s in merge_sources]
+    failed = set()
+    for t, (i, src_range, tgt_range) in enumerate(tasks):
+        last_task[i] = t
+    for i in cached:
+        source_stats[i] = cached[i]
+
+    process_options = {'batch_size': batch_size, 'adaptive_filters': adaptive_filters}
+
+    # Workers block when the writer is max_queued_batches behind, which
+    # keeps memory usage around max_queued_batches * batch_size
+    # Forking is required so that workers don't re-run the calling script
+    if use_processes and workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+        mp_context = multiprocessing.get_context("fork")
+        lines = mp_context.Queue(max_queued_batches)
+        # Load the fasttext model before forking, so that workers share its memory
+        if fasttext_path is not None:
+            load_fasttext(fasttext_path)
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=mp_context,
+                                       initializer=_init_merge_worker, initargs=(lines, fasttext_path))
+        print(f"Merging {len(process_tasks)} shards with {workers} processes")
+        futures = [executor.submit(_merge_worker, t, merge_sources[i], src_range, tgt_range, process_options) for t, i, src_range, tgt_range in process_tasks]
+    else:
+        lines = queue.Queue(max_queued_batches)
+        flmodel = load_fasttext(fasttext_path) if fasttext_path is not None else None
+        def thread_worker(idx, source, src_range, tgt_range):
+            stats = None
+            try:
+                profile = Profile()
+                stats = process_source(source, lambda s, t: lines.put((idx, s, t)), flmodel, src_range, tgt_range, profile=profile, **process_options)
+                stats += (profile.to_dict(),)
+            finally:
+                lines.put((idx, None, stats))
+        executor = ThreadPoolExecutor(max_workers=workers)
+        futures = [executor.submit(thread_worker, t, merge_sources[i], src_range, tgt_range) for t, i, src_range, tgt_range in process_tasks]
+
+    tees = {}
+    profiles = {}
+
+    def source_written(idx):
+        nonlocal total_count
+        i = tasks[idx][0]
+        if last_task[i] != idx:
+            return
+
+        count, augmented, filtered = source_stats[i]
+        if i in cached:
+            print(f"Using cached {merge_sources[i]['source']}")
+        else:
+            print(filtered)
+            print(f"Filtered {sum(filtered.values())} lines")
+            for f in tees.pop(i):
+                f.close()
+                if i in failed:
+                    os.unlink(f.name)
+            if i not in failed:
+                src_cache, tgt_cache, stats_cache = cache_paths(keys[i])
+                os.replace(src_cache + ".tmp", src_cache)
+                os.replace(tgt_cache + ".tmp", tgt_cache)
+                with open(stats_cache, "w", encoding="utf-8") as f:
+                    f.write(json.dumps(source_stats[i]))
 
-        print(filtered)
-        print(f"Filtered {sum(filtered.values())} lines")
         total_count += count + augmented
-        print(f"Added: {count + augmented} lines")
+        print(f"Added: {count + augmented} lines ({merge_sources[i]['source']})")
         print(f"New sentence count: {total_count}")
 
-    finished = False
+    # Unless near-duplicates are removed (which needs the whole merged corpus),
+    # merged pairs are streamed directly into the buckets of the shuffle,
+    # which also removes duplicates and writes the training/validation sets
+    fused = not remove_near_duplicates
+    if fused:
+        # The number of buckets is derived from the size of the sources (rather
+        # than of their cached output), so that the same sources give the same
+        # shuffle for a given seed, whether they were cached or not
+        estimate = sum(archive.size(s['source']) + archive.size(s['target']) for s in merge_sources)
+        out = BucketShuffle(num_buckets(estimate, shuffle_memory_limit), shuffle_seed, tmp_dir=out_dir,
+                            dedup_key=dedup_key if remove_duplicates else None, dedup_bits=dedup_bits,
+                            dedup_memory_limit=dedup_memory_limit)
+    else:
+        # The merged pairs are kept in a corpus (see corpus.py) between stages
+        out = CorpusWriter(os.path.join(out_dir, "corpus"))
 
-    def write_lines():
-        with open(os.path.join(out_dir, "src.txt"), "w", encoding="utf-8") as src, \
-             open(os.path.join(out_dir, "tgt.txt"), "w", encoding="utf-8") as tgt:
+    writer = MergeWriter(out, out_dir, on_written=source_written)
+    try:
+        for t, (i, src_range, tgt_range) in enumerate(tasks):
+            if i in cached:
+                src_cache, tgt_cache, stats_cache = cache_paths(keys[i])
+                writer.copy(t, src_cache, tgt_cache)
+            else:
+                if i not in tees:
+                    src_cache, tgt_cache, stats_cache = cache_paths(keys[i])
+                    tees[i] = (open(src_cache + ".tmp", "wb"), open(tgt_cache + ".tmp", "wb"))
+                writer.tee(t, *tees[i])
+
+        def next_batch():
+            # A worker process that dies (killed, crashed) never sends the end of
+            # its shard: its future fails instead (BrokenProcessPool)
             while True:
-                count = len(lines)
-                if count > 0:
-                    sbuf = StringIO()
-                    tbuf = StringIO()
-
-                    for x in range(count):
-                        l = lines.popleft()
-                        sbuf.write(l[0])
-                        tbuf.write(l[1])
-
-                    src.write(sbuf.getvalue())
-                    tgt.write(tbuf.getvalue())
-                elif finished:
-                    break
-                else:
-                    time.sleep(0.2)
-
-    writer = threading.Thread(target=write_lines)
-    writer.start()
-
-    # for s in sources:
-    #     process_source(s)
-    with ThreadPoolExecutor() as executor:
-        executor.map(process_source, list(sources.keys()))    
-    finished = True
-    writer.join()
-
-    #Use hashes of lines to sort duplicates for memory and compute efficiency
-    def hash_line(line):
-        return hashlib.md5(line.encode('utf-8')).hexdigest()
-
-    # Find duplicates (common hashes in both files)
-    def deduplicate(source, target):
-        source_dir = os.path.dirname(source)
-
-        with open(source, 'r+b') as src_fp, open(target, 'r+b') as tgt_fp, \
-                open(os.path.join(source_dir, "dedupsrc.txt"), 'w', encoding="utf-8") as dsc_fp, \
-                open(os.path.join(source_dir, "deduptgt.txt"), 'w', encoding="utf-8") as dtg_fp:
-
-            src_mm = mmap.mmap(src_fp.fileno(), 0)
-            tgt_mm = mmap.mmap(tgt_fp.fileno(), 0)
-            src_it = iter(src_mm.readline, b'')
-            tgt_it = iter(tgt_mm.readline, b'')
-            read = set()
-            duplicount = 0
-
-            for src_line in src_it:
-                line_s = src_line.decode("utf-8").strip()
-                line_t = next(tgt_it).decode("utf-8").strip()
-                hash_tuple = (hash_line(line_s), hash_line(line_t))
+                try:
+                    return lines.get(timeout=1)
+                except queue.Empty:
+                    for f in futures:
+                        if f.done() and not f.cancelled() and f.exception() is not None:
+                            raise f.exception()
 
-                if hash_tuple in read:
-                    duplicount += 1
-                else:
-                    read.add(hash_tuple)
-                    dsc_fp.write(line_s + '\n')
-                    dtg_fp.write(line_t + '\n')
-            src_mm.close()
-            tgt_mm.close()
-        os.unlink(source)
-        os.unlink(target)
-        os.rename(os.path.join(source_dir, "dedupsrc.txt"), source)
-        os.rename(os.path.join(source_dir, "deduptgt.txt"), target)
-        return(source, target, duplicount)
+        remaining = len(process_tasks)
+        while remaining > 0:
+            idx, src_bytes, tgt_bytes = next_batch()
+            if src_bytes is not None:
+                writer.write(idx, src_bytes, tgt_bytes)
+                continue
 
+            remaining -= 1
+            i = tasks[idx][0]
+            if tgt_bytes is None:
+                failed.add(i)
+            else:
+                count, augmented, filtered = source_stats[i]
+                for k, v in tgt_bytes[2].items():
+                    filtered[k] = filtered.get(k, 0) + v
+                source_stats[i] = (count + tgt_bytes[0], augmented + tgt_bytes[1], filtered)
+                profiles[i] = merge_profiles(profiles.get(i), tgt_bytes[3])
+            writer.done(idx)
+
+        # Raise worker errors, if any
+        for f in futures:
+            f.result()
+    except BaseException:
+        # Unblock the workers waiting on a full queue so that they can exit
+        for f in futures:
+            f.cancel()
+        while not all(f.done() for f in futures):
+            try:
+                lines.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        if fused:
+            out.close()
+        else:
+            out.discard()
+        raise
+    finally:
+        writer.close()
+        executor.shutdown()
+        for files in tees.values():
+            for f in files:
+                f.close()
+                os.unlink(f.name)
 
+    report = [source_report(s['source'], profiles.get(i), cached=i in cached) for i, s in enumerate(merge_sources)]
+    write_report(os.path.join(out_dir, "merge-profile.json"), report)
+    print(format_table(report))
 
     if total_count * 0.2 < max_eval_sentences:
         max_eval_sentences = total_count * 0.2
@@ -547,27 +1031,58 @@ def merge_shuffle(sources, out_dir, max_eval_sentences=5000, remove_duplicates=T
 
     if total_count == 0:
         print("No sources merged")
+        if fused:
+            out.close()
+        else:
+            out.discard()
         return
 
-    if remove_duplicates:
-        print("Removing duplicates")
-        src, tgt, removed = deduplicate(os.path.join(out_dir, "src.txt"), os.path.join(out_dir, "tgt.txt"))
-        print(f"Removed {removed} lines")
-    else: removed = 0
+    src_val = os.path.join(out_dir, "src-val.txt")
+    tgt_val = os.path.join(out_dir, "tgt-val.txt")
+
+    if fused:
+        if remove_duplicates:
+            print(f"Removing duplicates ({dedup_key}) and writing shuffled sets")
+        else:
+            print("Writing shuffled sets")
+        train_count, val_count, removed = out.split(src_train, tgt_train, src_val, tgt_val, max_eval_sentences)
+        if remove_duplicates:
+            print(f"Removed {removed} lines")
+        print(f"Training size: {train_count}")
+        print(f"Validation size: {val_count}")
+    else:
+        corpus = out.close()
+        # Both passes only find the pairs to drop: they are left out
+        # when the corpus is shuffled, without rewriting it
+        duplicates = None
+        removed = 0
+        if remove_duplicates:
+            # Common fingerprints of pairs, sources or targets
+            print(f"Removing duplicates ({dedup_key})")
+            duplicates = dedup.find_duplicates(corpus.src_path, corpus.tgt_path, key=dedup_key, bits=dedup_bits,
+                                               memory_limit=dedup_memory_limit, tmp_dir=out_dir)
+            removed = len(duplicates)
+            print(f"Removed {removed} lines")
 
-    print(f"Training size: {total_count - removed - max_eval_sentences}")
-    print(f"Validation size: {max_eval_sentences}")
+        from neardup import find_near_duplicates
+        print("Removing near-duplicates")
+        near_duplicates, clusters = find_near_duplicates(corpus.src_path, corpus.tgt_path, workers=workers,
+                                                         memory_limit=dedup_memory_limit, skip=duplicates)
+        print(f"Removed {len(near_duplicates)} near-duplicate lines ({clusters} clusters)")
+        removed += len(near_duplicates)
+        keep = ~near_duplicates.mask(len(corpus))
+        if duplicates is not None:
+            keep &= ~duplicates.mask(len(corpus))
 
-    print("Writing shuffled sets")
-    os.makedirs(out_dir, exist_ok=True)
+        print(f"Training size: {total_count - removed - max_eval_sentences}")
+        print(f"Validation size: {max_eval_sentences}")
 
-    src, tgt, src_sample, tgt_sample = file_shuffle_sample(os.path.join(out_dir, "src.txt"), os.path.join(out_dir, "tgt.txt"), max_eval_sentences)
-    os.rename(src, src_train)
-    os.rename(tgt, tgt_train)
-    os.rename(src_sample, os.path.join(out_dir, "src-val.txt"))
-    os.rename(tgt_sample, os.path.join(out_dir, "tgt-val.txt"))
+        # Training and validation sets are the only text files written
+        print("Writing shuffled sets")
+        shuffle_split(corpus.src_path, corpus.tgt_path, src_train, tgt_train, src_val, tgt_val,
+                      max_eval_sentences, seed=shuffle_seed, memory_limit=shuffle_memory_limit, keep=keep)
 
-    os.unlink(os.path.join(out_dir, "src.txt"))
-    os.unlink(os.path.join(out_dir, "tgt.txt"))
+        shutil.rmtree(corpus.path)
 
+    save_merge_hash(sources, out_dir, options)
     return True
\ No newline at end of file
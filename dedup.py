@@ -0,0 +1,324 @@
+import os
+import heapq
+import hashlib
+import tempfile
+import numpy as np
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+'''
+Exact deduplication of (source, target) pairs using compact fingerprints.
+
+Lines are reduced to 64 or 128 bit non-cryptographic fingerprints (xxh3 when
+the xxhash package is installed, blake2b otherwise), which are stored in an
+open addressing hash table backed by numpy arrays of unsigned 64 bit integers
+(8 or 16 bytes per slot instead of a Python tuple of md5 strings), which is
+probed one batch of lines at a time.
+When the table outgrows the memory limit it stops growing, and fingerprints that
+are not already in it are spilled to sorted runs on disk, which are merged
+at the end to find the remaining duplicates (external sort).
+'''
+
+DEDUP_KEYS = ("pair", "source", "target")
+
+# Bits used to store line numbers in spilled records
+LINE_BITS = 40
+LINE_MASK = (1 << LINE_BITS) - 1
+WORD_MASK = (1 << 64) - 1
+
+def fingerprint(data, bits=64):
+    """Non-zero integer fingerprint of a bytes object"""
+    if xxhash is not None:
+        fp = xxhash.xxh3_64_intdigest(data) if bits == 64 else xxhash.xxh3_128_intdigest(data)
+    else:
+        fp = int.from_bytes(hashlib.blake2b(data, digest_size=bits // 8).digest(), "little")
+    return fp or 1
+
+def dedup_data(src, tgt, key="pair"):
+    """Bytes to fingerprint for a pair, depending on the dedup key"""
+    if key == "source":
+        return src
+    elif key == "target":
+        return tgt
+    else:
+        # Lines cannot contain newlines, so this is unambiguous
+        return src + b"\n" + tgt
+
+def words(fps, bits=64):
+    """Fingerprints (Python ints) as a list of uint64 arrays, one per 64 bit word"""
+    if bits == 64:
+        return [np.array(fps, dtype=np.uint64)]
+    return [np.array([fp & WORD_MASK for fp in fps], dtype=np.uint64),
+            np.array([fp >> 64 for fp in fps], dtype=np.uint64)]
+
+def first_occurrences(words):
+    """Boolean array of the first occurrence of each fingerprint of a batch (see words)"""
+    n = len(words[0])
+    order = np.lexsort([np.arange(n)] + words[::-1])
+    same = np.ones(max(0, n - 1), dtype=bool)
+    for w in words:
+        w = w[order]
+        same &= w[1:] == w[:-1]
+    first = np.ones(n, dtype=bool)
+    first[order[1:][same]] = False
+    return first
+
+class FingerprintTable:
+    """Set of fingerprints (linear probing over arrays of uint64),
+    optionally mapping each fingerprint to an unsigned integer value.
+    Fingerprints are looked up and added in batches (see words), all the
+    lines of a batch probing the table at once with numpy."""
+
+    def __init__(self, bits=64, capacity=1 << 16, values=False):
+        self.words = bits // 64
+        self.has_values = values
+        self.size = 0
+        self._alloc(capacity)
+
+    def _alloc(self, capacity):
+        self.capacity = capacity
+        self.mask = capacity - 1
+        self.slots = [np.zeros(capacity, dtype=np.uint64) for w in range(self.words)]
+        self.values = np.zeros(capacity, dtype=np.uint64) if self.has_values else None
+
+    @property
+    def nbytes(self):
+        return self.capacity * 8 * (self.words + (1 if self.has_values else 0))
+
+    def grow_nbytes(self):
+        """Memory needed by the next resize"""
+        return self.nbytes * 3
+
+    def needs_grow(self, count=1):
+        """Whether adding count fingerprints would fill more than 2/3 of the table"""
+        return (self.size + count) * 3 >= self.capacity * 2
+
+    def grow(self):
+        used = self._occupied(slice(None))
+        old = [s[used] for s in self.slots]
+        old_values = self.values[used] if self.has_values else None
+        self._alloc(self.capacity * 2)
+        self.size = 0
+        self.add(old, old_values)
+
+    def _probe(self, index, words):
+        """(empty, found) arrays of the slots at index, for the fingerprints words"""
+        empty = np.ones(len(index), dtype=bool)
+        found = np.ones(len(index), dtype=bool)
+        for slots, w in zip(self.slots, words):
+            k = slots[index]
+            empty &= k == 0
+            found &= k == w
+        return empty, found
+
+    def _find(self, words):
+        """Slots of a batch of fingerprints, or of the empty slots where they would be inserted"""
+        index = (words[0] & np.uint64(self.mask)).astype(np.int64)
+        pending = np.arange(len(index))
+        while len(pending) > 0:
+            empty, found = self._probe(index[pending], [w[pending] for w in words])
+            pending = pending[~(empty | found)]
+            index[pending] = (index[pending] + 1) & self.mask
+        return index
+
+    def _occupied(self, index):
+        occupied = self.slots[0][index] != 0
+        for slots in self.slots[1:]:
+            occupied |= slots[index] != 0
+        return occupied
+
+    def contains(self, words):
+        """Boolean array of the fingerprints of a batch that are in the table"""
+        return self._occupied(self._find(words))
+
+    def get(self, words):
+        """(found, values) arrays of a batch of fingerprints (values are 0 when not found)"""
+        index = self._find(words)
+        found = self._occupied(index)
+        return found, np.where(found, self.values[index], np.uint64(0))
+
+    def add(self, words, values=None):
+        """Add a batch of fingerprints, which must fit in the table (see needs_grow).
+        A fingerprint that is already present, or repeated in the batch, keeps its
+        first value. Returns the boolean array of the fingerprints that were added."""
+        n = len(words[0])
+        index = (words[0] & np.uint64(self.mask)).astype(np.int64)
+        added = np.zeros(n, dtype=bool)
+        pending = np.arange(n)
+        while len(pending) > 0:
+            at = index[pending]
+            empty, found = self._probe(at, [w[pending] for w in words])
+            # The first fingerprint that reaches an empty slot takes it; the others
+            # reaching it look at it again, since it may now hold the same fingerprint
+            empty_at = np.flatnonzero(empty)
+            slots, first = np.unique(at[empty_at], return_index=True)
+            taken = pending[empty_at[first]]
+            for table, w in zip(self.slots, words):
+                table[slots] = w[taken]
+            if self.has_values and values is not None:
+                self.values[slots] = values[taken]
+            added[taken] = True
+            self.size += len(taken)
+
+            moved = ~(empty | found)
+            index[pending[moved]] = (at[moved] + 1) & self.mask
+            keep = ~found
+            keep[empty_at[first]] = False
+            pending = pending[keep]
+        return added
+
+class LineSet:
+    """Set of line numbers (bitmap)"""
+
+    def __init__(self):
+        self.bits = bytearray()
+        self.count = 0
+
+    def add(self, n):
+        byte = n >> 3
+        if byte >= len(self.bits):
+            self.bits.extend(bytes(max(byte + 1 - len(self.bits), len(self.bits))))
+        mask = 1 << (n & 7)
+        if not self.bits[byte] & mask:
+            self.bits[byte] |= mask
+            self.count += 1
+
+    def update(self, lines):
+        """Add an array of line numbers"""
+        lines = np.unique(np.asarray(lines, dtype=np.int64))
+        if len(lines) == 0:
+            return
+        size = int(lines[-1] >> 3) + 1
+        if size > len(self.bits):
+            self.bits.extend(bytes(max(size - len(self.bits), len(self.bits))))
+        bits = np.frombuffer(self.bits, dtype=np.uint8)
+        byte = lines >> 3
+        mask = (1 << (lines & 7)).astype(np.uint8)
+        self.count += int(np.count_nonzero(bits[byte] & mask == 0))
+        np.bitwise_or.at(bits, byte, mask)
+        del bits
+
+    def __contains__(self, n):
+        byte = n >> 3
+        return byte < len(self.bits) and (self.bits[byte] & (1 << (n & 7))) != 0
+
+    def __len__(self):
+        return self.count
+
+    def mask(self, size):
+        """Boolean array of the line numbers in the set, for lines [0, size)"""
+        bits = np.unpackbits(np.frombuffer(bytes(self.bits), dtype=np.uint8), bitorder="little")[:size]
+        return np.concatenate([bits, np.zeros(size - len(bits), dtype=np.uint8)]).astype(bool)
+
+class Deduplicator:
+    """Finds the line numbers of repeated fingerprints (the first occurrence is kept).
+    Line numbers must be added in increasing order."""
+
+    def __init__(self, bits=64, memory_limit=1024 * 1024 * 1024, tmp_dir=None):
+        self.bits = bits
+        self.memory_limit = memory_limit
+        self.tmp_dir = tmp_dir
+        self.table = FingerprintTable(bits)
+        self.spilling = False
+        self.buffer = []
+        # Python ints of ~100-170 bits in a list
+        self.buffer_limit = max(1 << 16, memory_limit // 2 // 56)
+        self.runs = []
+        self.duplicates = LineSet()
+        self.record_size = bits // 8 + LINE_BITS // 8
+
+    def add(self, first_line, fps):
+        """Add the fingerprints of a batch of consecutive lines, from first_line.
+        After spilling to disk, duplicates of fingerprints that are not in memory
+        are only found by finish()"""
+        if len(fps) == 0:
+            return
+        lines = np.arange(first_line, first_line + len(fps), dtype=np.int64)
+        batch = words(fps, self.bits)
+        first = first_occurrences(batch)
+        self.duplicates.update(lines[~first])
+        first = np.flatnonzero(first)
+        known = self.table.contains([w[first] for w in batch])
+        self.duplicates.update(lines[first[known]])
+        new = first[~known]
+
+        if not self.spilling:
+            while self.table.needs_grow(len(new)):
+                if self.table.grow_nbytes() > self.memory_limit:
+                    print(f"Deduplication exceeds {self.memory_limit // (1024 * 1024)}MB, spilling to disk")
+                    self.spilling = True
+                    break
+                self.table.grow()
+            if not self.spilling:
+                self.table.add([w[new] for w in batch])
+                return
+
+        for i in new.tolist():
+            self.buffer.append((fps[i] << LINE_BITS) | (first_line + i))
+        if len(self.buffer) >= self.buffer_limit:
+            self._write_run()
+
+    def _write_run(self):
+        self.buffer.sort()
+        fd, path = tempfile.mkstemp(prefix="dedup-", suffix=".run", dir=self.tmp_dir)
+        with os.fdopen(fd, "wb") as f:
+            size = self.record_size
+            f.write(b"".join(r.to_bytes(size, "big") for r in self.buffer))
+        self.runs.append(path)
+        self.buffer = []
+
+    def _read_run(self, path, chunk_records=65536):
+        size = self.record_size
+        with open(path, "rb") as f:
+            while True:
+                chunk = f.read(size * chunk_records)
+                if not chunk:
+                    break
+                for i in range(0, len(chunk), size):
+                    yield int.from_bytes(chunk[i:i + size], "big")
+
+    def finish(self):
+        """Returns the LineSet of duplicate line numbers"""
+        if self.spilling:
+            if len(self.runs) == 0:
+                self.buffer.sort()
+                records = self.buffer
+            else:
+                if len(self.buffer) > 0:
+                    self._write_run()
+                records = heapq.merge(*[self._read_run(r) for r in self.runs])
+
+            last_fp = None
+            for r in records:
+                fp = r >> LINE_BITS
+                if fp == last_fp:
+                    self.duplicates.add(r & LINE_MASK)
+                last_fp = fp
+
+            for r in self.runs:
+                os.unlink(r)
+            self.runs = []
+            self.buffer = []
+
+        return self.duplicates
+
+def find_duplicates(source, target, key="pair", bits=64, memory_limit=1024 * 1024 * 1024, tmp_dir=None, batch_lines=100000):
+    """Returns the LineSet of the line numbers of repeated pairs of source/target"""
+    if key not in DEDUP_KEYS:
+        raise ValueError(f"Invalid dedup key {key} (must be one of {', '.join(DEDUP_KEYS)})")
+
+    dedup = Deduplicator(bits, memory_limit, tmp_dir=tmp_dir)
+    with open(source, "rb") as src_fp, open(target, "rb") as tgt_fp:
+        line_no = 0
+        fps = []
+        for line_s, line_t in zip(src_fp, tgt_fp):
+            fps.append(fingerprint(dedup_data(line_s.strip(), line_t.strip(), key), bits))
+            if len(fps) >= batch_lines:
+                dedup.add(line_no, fps)
+                line_no += len(fps)
+                fps = []
+        dedup.add(line_no, fps)
+    return dedup.finish()
@@ -0,0 +1,76 @@
+import os
+import sys
+import ctranslate2
+
+'''
+Spreads onmt_train over the devices of the machine.
+
+With N GPUs, training runs one process per GPU (world_size N, gpu_ranks 0..N-1).
+The default batch_size and accum_count are tuned for a single GPU, so they are
+rescaled to keep the effective batch (batch_size * accum_count * world_size)
+the same: gradients are accumulated over fewer steps, and batches are made
+smaller when there are more GPUs than accumulation steps. The CPUs are split
+between the data loader workers of each rank.
+
+Without GPUs, training runs in a single process (OpenNMT-py only starts
+distributed ranks on GPUs): some CPUs run data loader worker processes, and
+the others the intra-op threads of the training process.
+'''
+
+MAX_WORKERS_PER_RANK = 4
+
+def gpu_count():
+    if sys.platform == 'darwin':
+        return 0
+    return ctranslate2.get_cuda_device_count()
+
+def rescale_batch(batch_size, accum_count, world_size, multiple=8):
+    """(batch_size, accum_count) of each of world_size devices that keep the
+    effective batch of batch_size * accum_count on a single device"""
+    effective = batch_size * accum_count
+    accum_count = max(1, round(accum_count / world_size))
+    batch_size = max(1, effective // (accum_count * world_size))
+    if batch_size >= multiple:
+        batch_size -= batch_size % multiple
+    return batch_size, accum_count
+
+def fit_batch(batch_size, accum_count, max_batch_size, multiple=8):
+    """(batch_size, accum_count) with the effective batch of batch_size * accum_count,
+    and a batch_size of at most max_batch_size (see probe.py)"""
+    effective = batch_size * accum_count
+    accum_count = max(1, -(-effective // max_batch_size))
+    batch_size = min(max_batch_size, effective // accum_count)
+    if batch_size >= multiple:
+        batch_size -= batch_size % multiple
+    return batch_size, accum_count
+
+def configure(onmt_config, config):
+    """Set the device options of onmt_config (world_size, gpu_ranks, batch_size,
+    accum_count, num_worker) that aren't set in config. Returns the environment
+    variables to run onmt_train with."""
+    cpus = os.cpu_count() or 1
+    gpus = gpu_count()
+    if config.get('gpus') is not None:
+        gpus = min(gpus, config['gpus'])
+    user_defined = 'world_size' in config or 'gpu_ranks' in config
+
+    if gpus == 0:
+        print(f"Training on CPU ({cpus} cores)")
+        if not user_defined:
+            onmt_config['world_size'] = 1
+            onmt_config.pop('gpu_ranks', None)
+        if 'num_worker' not in config:
+            onmt_config['num_worker'] = max(1, min(MAX_WORKERS_PER_RANK, cpus // 4))
+        return {'OMP_NUM_THREADS': str(max(1, cpus - onmt_config['num_worker']))}
+
+    if not user_defined:
+        onmt_config['world_size'] = gpus
+        onmt_config['gpu_ranks'] = list(range(gpus))
+        if gpus > 1 and isinstance(onmt_config['accum_count'], int):
+            onmt_config['batch_size'], onmt_config['accum_count'] = rescale_batch(onmt_config['batch_size'], onmt_config['accum_count'], gpus)
+    world_size = onmt_config['world_size']
+    if 'num_worker' not in config:
+        onmt_config['num_worker'] = max(1, min(MAX_WORKERS_PER_RANK, cpus // world_size - 1))
+    print(f"Training on {world_size} GPU(s), batch_size {onmt_config['batch_size']}, accum_count {onmt_config['accum_count']}, "
+          f"{onmt_config['num_worker']} data loader worker(s) per GPU")
+    return {}
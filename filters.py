@@ -1,3 +1,86 @@
+def _batch(batch_func):
+    """
+    Attach a batch implementation to a filter. batch_func takes a list of sources,
+    a list of targets and the filter arguments, and returns a sequence of booleans
+    (True to remove the pair), one per pair
+    """
+    def decorator(func):
+        func.batch = batch_func
+        return func
+    return decorator
+
+def _lengths(lines):
+    import numpy as np
+    return np.fromiter(map(len, lines), dtype=np.int64, count=len(lines))
+
+_LATIN = set('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
+
+# ASCII characters of each class, deleted with bytes.translate to count them
+_ASCII_UPPER = b'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
+_ASCII_LATIN = _ASCII_UPPER + b'abcdefghijklmnopqrstuvwxyz'
+_ASCII_DIGITS = b'0123456789'
+_ASCII_NONZERO_DIGITS = b'123456789'
+_ASCII_NONALPHANUM = bytes(c for c in range(128) if c != 32 and not chr(c).isalnum())
+_ASCII = bytes(range(128))
+
+# Character -> (upper, digit, non-zero decimal, non-alphanumeric, latin) flags
+_char_classes = {}
+
+def _char_class(ch):
+    c = _char_classes.get(ch)
+    if c is None:
+        c = _char_classes[ch] = (int(ch.isupper()), int(ch.isdigit()), int(ch.isdecimal() and int(ch) != 0),
+                                 int(ch != ' ' and not ch.isalnum()), int(ch in _LATIN))
+    return c
+
+class _Features:
+    """Character class counts of a line, computed once and shared by all filters"""
+    __slots__ = ("length", "upper", "digits", "nonzero_digits", "nonalphanum", "latin")
+
+    def __init__(self, line):
+        self.length = len(line)
+
+        # ASCII bytes never appear inside multi-byte UTF-8 sequences,
+        # so ASCII characters can be counted on the encoded line
+        b = line.encode("utf-8")
+        size = len(b)
+        upper = size - len(b.translate(None, _ASCII_UPPER))
+        digits = size - len(b.translate(None, _ASCII_DIGITS))
+        nonzero_digits = size - len(b.translate(None, _ASCII_NONZERO_DIGITS))
+        nonalphanum = size - len(b.translate(None, _ASCII_NONALPHANUM))
+        latin = size - len(b.translate(None, _ASCII_LATIN))
+
+        if size != self.length:
+            for ch in b.translate(None, _ASCII).decode("utf-8"):
+                c = _char_classes.get(ch) or _char_class(ch)
+                upper += c[0]
+                digits += c[1]
+                nonzero_digits += c[2]
+                nonalphanum += c[3]
+                latin += c[4]
+
+        self.upper = upper
+        self.digits = digits
+        self.nonzero_digits = nonzero_digits
+        self.nonalphanum = nonalphanum
+        self.latin = latin
+
+# Features of the lines of the current batch, shared by all filters
+_FEATURE_CACHE_SIZE = 1 << 14
+_feature_cache = {}
+
+def _features(line):
+    f = _feature_cache.get(line)
+    if f is None:
+        if len(_feature_cache) >= _FEATURE_CACHE_SIZE:
+            _feature_cache.clear()
+        f = _feature_cache[line] = _Features(line)
+    return f
+
+def _never(srcs, tgts, **kwargs):
+    return [False] * len(srcs)
+
+@_batch(_never)
 def excerpt(src, tgt, top_percentile, bottom_percentile):
     """
     Only add the lines between top X% and botom Y% from the dataset
@@ -7,6 +90,7 @@ def excerpt(src, tgt, top_percentile, bottom_percentile):
     """
     return False # placeholder
 
+@_batch(_never)
 def top(src, tgt, percent):
     """
     Only add the top X% lines from the dataset
@@ -15,12 +99,22 @@ def top(src, tgt, percent):
     """
     return False # placeholder
 
+def _duplicates_batch(srcs, tgts):
+    return [src == tgt for src, tgt in zip(srcs, tgts)]
+
+@_batch(_duplicates_batch)
 def duplicates(src, tgt):
     """
     Remove lines when source is the same as target
     """
     return src == tgt
 
+def _char_length_batch(srcs, tgts, min = 0, max = float("inf")):
+    s = _lengths(srcs)
+    t = _lengths(tgts)
+    return (s <= min) | (s >= max) | (t <= min) | (t >= max)
+
+@_batch(_char_length_batch)
 def char_length(src, tgt, min = 0, max = float("inf")):
     """
     Removes lines outside of a certain character length
@@ -31,6 +125,11 @@ def char_length(src, tgt, min = 0, max = float("inf")):
     return len(src) <= min or len(src) >= max or \
            len(tgt) <= min or len(tgt) >= max
 
+def _source_target_ratio_batch(srcs, tgts, min = 0, max = float("inf")):
+    ratio = _lengths(srcs) / _lengths(tgts)
+    return (ratio <= min) | (ratio >= max)
+
+@_batch(_source_target_ratio_batch)
 def source_target_ratio(src, tgt, min = 0, max = float("inf")):
     """
     Removes lines when the ratio (len(source) / len(target)) is outside of bounds
@@ -45,7 +144,7 @@ def uppercase_count_mismatch(src, tgt):
     """
     Removes lines when source and target have a different number of uppercase letters
     """
-    return sum(1 for ch in src if ch.isupper()) != sum(1 for ch in tgt if ch.isupper())
+    return _features(src).upper != _features(tgt).upper
 
 def contains(src, tgt, words = []):
     """
@@ -65,8 +164,8 @@ def digits_ratio(src, tgt, max = 0.4):
 
     :param float max: Maximum ratio (default: 0.4)
     """
-    return len([c for c in src if c.isdigit()]) / len(src) >= max or \
-                len([c for c in tgt if c.isdigit()]) / len(tgt) >= max
+    return _features(src).digits / len(src) >= max or \
+                _features(tgt).digits / len(tgt) >= max
 
 def nonalphanum_ratio(src, tgt, max = 0.4):
     """
@@ -75,22 +174,23 @@ def nonalphanum_ratio(src, tgt, max = 0.4):
 
     :param float max: Maximum ratio (default: 0.4)
     """
-    return len([c for c in src if c != ' ' and (not c.isalnum())]) / len(src) >= max or \
-                len([c for c in tgt if c != ' ' and (not c.isalnum())]) / len(tgt) >= max
+    return _features(src).nonalphanum / len(src) >= max or \
+                _features(tgt).nonalphanum / len(tgt) >= max
 
 def digits_mismatch(src, tgt):
     """
     Removes lines when there are digits in source and not in target, or vice-versa
     """
-    s = sum(int(num) for num in src if num.isdecimal())
-    t = sum(int(num) for num in tgt if num.isdecimal())
+    # The sum of the digits is zero exactly when there are no non-zero digits
+    s = _features(src).nonzero_digits
+    t = _features(tgt).nonzero_digits
     return (s == 0 and t > 0) or (t == 0 and s > 0)
 
 def nonalphanum_count_mismatch(src, tgt):
     """
     Removes lines when the sum of non-alphanumeric characters (except spaces) between source and target is not the same
     """
-    return sum(1 for ch in src if ch != " " and (not ch.isalnum())) != sum(1 for ch in tgt if ch != " " and (not ch.isalnum()))
+    return _features(src).nonalphanum != _features(tgt).nonalphanum
 
 def characters_count_mismatch(src, tgt, chars = '()[]?!:"“”{}'):
     """
@@ -117,12 +217,46 @@ def first_char_mismatch(src, tgt):
     else:
         return src[0] != tgt[0]
 
-def fast_lang(src, tgt, s_lang, t_lang, model):
+# Language predictions of fast_lang, by fingerprint of the line
+_LANG_CACHE_SIZE = 1 << 20
+_lang_cache = {}
+
+def _predict_langs(model, lines):
+    from dedup import fingerprint
+    fps = [fingerprint(line.encode("utf-8")) for line in lines]
+    found = {}
+    missing = {}
+    for fp, line in zip(fps, lines):
+        pred = _lang_cache.get(fp)
+        if pred is None:
+            missing[fp] = line
+        else:
+            found[fp] = pred
+
+    if len(missing) > 0:
+        if len(_lang_cache) + len(missing) > _LANG_CACHE_SIZE:
+            _lang_cache.clear()
+        labels, probs = model.predict(list(missing.values()))
+        for fp, label, prob in zip(missing, labels, probs):
+            found[fp] = _lang_cache[fp] = (label[0].replace("__label__", ''), float(prob[0]))
+
+    return [found[fp] for fp in fps]
+
+def _fast_lang_batch(srcs, tgts, s_lang, t_lang, model, min_confidence = 0):
+    remove = []
+    for (src_lang, src_prob), (tgt_lang, tgt_prob) in zip(_predict_langs(model, srcs), _predict_langs(model, tgts)):
+        remove.append(src_lang != s_lang or tgt_lang != t_lang or \
+                      src_prob < min_confidence or tgt_prob < min_confidence)
+    return remove
+
+@_batch(_fast_lang_batch)
+def fast_lang(src, tgt, s_lang, t_lang, model, min_confidence = 0):
     """
     Removes lines when the languages detected using fasttext language identification differ from those specified in config.
+
+    :param float min_confidence: Also remove lines when the confidence of the detected language is below this value (default: 0)
     """
-    return s_lang != model.predict(src)[0][0].replace("__label__", '') or \
-       t_lang != model.predict(tgt)[0][0].replace("__label__", '')
+    return _fast_lang_batch([src], [tgt], s_lang, t_lang, model, min_confidence)[0]
 
 def limit_latin_chars(src, tgt, s_chset, t_chset, max = 12):
     """
@@ -130,16 +264,9 @@ def limit_latin_chars(src, tgt, s_chset, t_chset, max = 12):
     Max = 12 retains most named entities and acronyms.
     For emails, reinject filtered data with max value at 20-30
     """
-    def latin_char_count(sent):
-        count = 0
-        latin_set = set('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ')
-        for ch in sent:
-            if ch in latin_set:
-                count +=1
-        return count
     if s_chset != "Latn":
-        return latin_char_count(src) > max
+        return _features(src).latin > max
     elif t_chset != "Latn":
-        return latin_char_count(tgt) > max
+        return _features(tgt).latin > max
     else:
         return False
\ No newline at end of file
@@ -3,7 +3,8 @@ import io
 import json
 import os
 import hashlib
-import mmap
+import archive
+from search import Matcher, scan, scan_stream, index_search
 
 parser = argparse.ArgumentParser(description='Find text in data sources')
 parser.add_argument('-c', '--config',
@@ -12,10 +13,22 @@ parser.add_argument('-c', '--config',
     help='Path to model-config.json. Default: %(default)s')
 parser.add_argument('-t', '--text',
     type=str,
-    help='Text to search. Default: %(default)s')
+    action="append",
+    required=True,
+    help='Text to search (can be repeated to search several texts at once)')
 parser.add_argument('-e', '--exact',
     action="store_true",
     help='Exact match')
+parser.add_argument('-i', '--index',
+    action="store_true",
+    help='Use (and build or update if needed) a trigram index of the sources in cache/index, for faster searches')
+parser.add_argument('-r', '--regex',
+    action="store_true",
+    help='Texts are regular expressions, matched against lowercased lines (cannot use the index)')
+parser.add_argument('-j', '--jobs',
+    type=int,
+    default=None,
+    help='Number of processes used to scan the sources. Default: number of CPU cores')
 
 args = parser.parse_args() 
 try:
@@ -29,7 +42,7 @@ current_dir = os.path.dirname(__file__)
 cache_dir = os.path.join(current_dir, "cache")
 sources = {}
 
-text = args.text.lower()
+matcher = Matcher(args.text, regex=args.regex, exact=args.exact)
 
 for s in config['sources']:
     if isinstance(s, dict):
@@ -40,10 +53,13 @@ for s in config['sources']:
     else:
         md5 = hashlib.md5(s.encode('utf-8')).hexdigest()
         source_dir = os.path.join(cache_dir, md5)
+        if not os.path.isdir(source_dir):
+            # Not extracted
+            source_dir += ".zip"
 
-    if os.path.isdir(source_dir):
+    if os.path.exists(source_dir):
         source, target = None, None
-        for f in [f.path for f in os.scandir(source_dir) if f.is_file()]:
+        for f in archive.list_files(source_dir):
             if "target" in f.lower():
                 target = f
             elif f.lower().endswith(f".{config['to']['code']}"):
@@ -55,24 +71,16 @@ for s in config['sources']:
                 source = f
 
         if source is not None and target is not None:
-            def scan(file):
-                with open(file, 'r+b') as f:
-                    mm = mmap.mmap(f.fileno(), 0)
-                    it = iter(mm.readline, b"")
+            if archive.is_stream(source) or archive.is_stream(target):
+                pairs = scan_stream(source, target, matcher)
+            elif args.index and not args.regex:
+                pairs = index_search(source, target, matcher, cache_dir)
+            else:
+                pairs = scan(source, target, matcher, workers=args.jobs)
 
-                    i = 1
-                    for line in it:
-                        line_s = line.decode("utf-8")
-                        if args.exact:
-                            if text == line_s.lower().strip():
-                                print(f"{os.path.basename(s)} ({file}):{i} => {line_s}")
-                        else:
-                            if text in line_s.lower():
-                                print(f"{os.path.basename(s)} ({file}):{i} => {line_s}")
-                        i += 1
-                    mm.close()
-            scan(source)
-            scan(target)                
+            for i, line_s, line_t in pairs:
+                print(f"{os.path.basename(s)} ({source}):{i} => {line_s}")
+                print(f"{os.path.basename(s)} ({target}):{i} => {line_t}")
         else:
             print(f"Cannot find a source.txt and a target.txt in {s} ({dir}). Skipping...")
     else:
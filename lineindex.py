@@ -0,0 +1,120 @@
+import os
+import mmap
+import struct
+import numpy as np
+
+'''
+Persistent line-offset index of text files.
+
+The index of a file is stored next to it (e.g. source.txt.lineidx) as a small
+header (magic, size and mtime of the indexed file, number of lines) followed
+by a uint64 array with the byte offset at which each line after the first begins
+(i.e. the offset after each newline). It is built once with a bytes-level scan,
+rebuilt when the size or mtime of the file change, and memory-mapped, which gives
+O(1) line counts and direct seeks to any line.
+'''
+
+INDEX_EXT = ".lineidx"
+MAGIC = b"LINEIDX1"
+HEADER = struct.Struct("<8sQQQ")
+
+def index_path(path):
+    return path + INDEX_EXT
+
+def scan_newlines(path, chunk_size=64 * 1024 * 1024):
+    """Yields uint64 arrays of the offsets following each newline of a file"""
+    size = os.path.getsize(path)
+    if size == 0:
+        return
+    with open(path, "rb") as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for start in range(0, size, chunk_size):
+                chunk = np.frombuffer(mm, dtype=np.uint8, count=min(chunk_size, size - start), offset=start)
+                yield (np.flatnonzero(chunk == 10) + (start + 1)).astype(np.uint64)
+                del chunk
+        finally:
+            mm.close()
+
+class LineIndex:
+    def __init__(self, offsets, size):
+        self.offsets = offsets
+        self.size = size
+
+    @property
+    def count(self):
+        """Number of newlines in the file (same as wc -l)"""
+        return len(self.offsets)
+
+    def line_offset(self, line):
+        """Byte offset at which a (0-based) line begins.
+        Lines past the end of the file map to its size."""
+        if line <= 0:
+            return 0
+        if line > len(self.offsets):
+            return self.size
+        return int(self.offsets[line - 1])
+
+    def line_offsets(self, lines):
+        return [self.line_offset(l) for l in lines]
+
+    def next_line(self, offset):
+        """(line, offset) of the first line beginning after a byte offset,
+        or None if there is none"""
+        i = int(np.searchsorted(self.offsets, offset, side="right"))
+        if i >= len(self.offsets):
+            return None
+        return i + 1, int(self.offsets[i])
+
+def _read_header(path, st):
+    try:
+        with open(index_path(path), "rb") as f:
+            header = f.read(HEADER.size)
+    except OSError:
+        return None
+    if len(header) != HEADER.size:
+        return None
+    magic, size, mtime_ns, count = HEADER.unpack(header)
+    if magic != MAGIC or size != st.st_size or mtime_ns != st.st_mtime_ns:
+        return None
+    if os.path.getsize(index_path(path)) != HEADER.size + count * 8:
+        return None
+    return count
+
+def _map(path, count):
+    if count == 0:
+        return np.zeros(0, dtype=np.uint64)
+    return np.memmap(index_path(path), dtype=np.uint64, mode="r", offset=HEADER.size, shape=(count,))
+
+def build(path):
+    """Build the index of a file. The offsets of each chunk are written next to
+    the file as they are found, and the saved index is memory-mapped. Returns
+    the uint64 offsets (kept in memory when the directory isn't writable)."""
+    st = os.stat(path)
+    tmp = index_path(path) + ".tmp"
+    try:
+        count = 0
+        with open(tmp, "wb") as f:
+            f.write(HEADER.pack(MAGIC, st.st_size, st.st_mtime_ns, 0))
+            for offsets in scan_newlines(path):
+                f.write(offsets.tobytes())
+                count += len(offsets)
+            f.seek(0)
+            f.write(HEADER.pack(MAGIC, st.st_size, st.st_mtime_ns, count))
+        os.replace(tmp, index_path(path))
+        return _map(path, count)
+    except OSError as e:
+        print(f"Cannot save line index of {path}: {e}")
+        if os.path.isfile(tmp):
+            os.unlink(tmp)
+    parts = list(scan_newlines(path))
+    return np.concatenate(parts) if len(parts) > 0 else np.zeros(0, dtype=np.uint64)
+
+def load(path):
+    """LineIndex of a file, built if it's missing or stale"""
+    st = os.stat(path)
+    count = _read_header(path, st)
+    if count is None:
+        print(f"Indexing lines of {path}")
+        return LineIndex(build(path), st.st_size)
+    return LineIndex(_map(path, count), st.st_size)
@@ -0,0 +1,205 @@
+import os
+import re
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from dedup import FingerprintTable, LineSet
+
+'''
+Near-duplicate detection of (source, target) pairs with MinHash and LSH.
+
+Pairs are normalized (lowercased, punctuation and whitespace removed), split into
+character shingles and reduced to MinHash signatures, computed with numpy one
+batch of lines at a time. Signatures are cut into bands; two pairs sharing the
+same band are considered near-duplicates and only the first one is kept.
+With 8 bands of 8 rows, pairs with a Jaccard similarity above ~0.8 are
+very likely to be collapsed, pairs below ~0.5 very unlikely.
+'''
+
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+_non_word = re.compile(r"[\W_]+")
+
+def normalize(line):
+    return _non_word.sub("", line.lower())
+
+class MinHashLSH:
+    def __init__(self, num_perm=64, bands=8, shingle_size=5, seed=1):
+        if num_perm % bands != 0:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, MAX_HASH, size=num_perm, dtype=np.uint64)
+        self.b = rng.randint(0, MAX_HASH, size=num_perm, dtype=np.uint64)
+        self.band_mult = rng.randint(1, MAX_HASH, size=(bands, self.rows), dtype=np.uint64) | np.uint64(1)
+        self.band_salt = rng.randint(1, MAX_HASH, size=bands, dtype=np.uint64) << np.uint64(32)
+
+    def shingles(self, texts):
+        """32 bit hashes of the character shingles of texts, and the offset
+        of the first shingle of each text"""
+        k = self.shingle_size
+        texts = [t.ljust(k, "\x00") for t in texts]
+        lengths = np.array([len(t) for t in texts], dtype=np.int64)
+        cps = np.frombuffer("".join(texts).encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+
+        # Polynomial hash of every k consecutive codepoints (uint64 arithmetic wraps)
+        n = len(cps) - k + 1
+        h = np.zeros(n, dtype=np.uint64)
+        for j in range(k):
+            h = h * np.uint64(1000003) + cps[j:j + n]
+
+        # Drop shingles that span two texts
+        counts = lengths - k + 1
+        starts = np.cumsum(lengths) - lengths
+        line_of = np.repeat(np.arange(len(texts)), lengths)[:n]
+        valid = np.arange(n) - starts[line_of] < counts[line_of]
+        h = h[valid]
+
+        h ^= h >> np.uint64(29)
+        h *= np.uint64(0xBF58476D1CE4E5B9)
+        h ^= h >> np.uint64(32)
+        offsets = np.cumsum(counts) - counts
+        return h & np.uint64(MAX_HASH), offsets
+
+    def signatures(self, texts, perm_block=16):
+        """(num_perm, len(texts)) array of MinHash signatures"""
+        h, offsets = self.shingles(texts)
+        sig = np.empty((self.num_perm, len(texts)), dtype=np.uint64)
+        for p in range(0, self.num_perm, perm_block):
+            a = self.a[p:p + perm_block, None]
+            b = self.b[p:p + perm_block, None]
+            values = ((a * h[None, :] + b) % np.uint64(MERSENNE_PRIME)) & np.uint64(MAX_HASH)
+            sig[p:p + perm_block] = np.minimum.reduceat(values, offsets, axis=1)
+        return sig
+
+    def band_keys(self, texts):
+        """(len(texts), bands) array of non-zero 64 bit band keys"""
+        sig = self.signatures(texts).reshape(self.bands, self.rows, len(texts))
+        keys = (sig * self.band_mult[:, :, None]).sum(axis=1, dtype=np.uint64)
+        keys ^= self.band_salt[:, None]
+        keys[keys == 0] = 1
+        return keys.T
+
+_lsh = None
+
+def _init_worker(num_perm, bands, shingle_size, seed):
+    global _lsh
+    _lsh = MinHashLSH(num_perm, bands, shingle_size, seed)
+
+def _band_keys(src_bytes, tgt_bytes):
+    src_lines = src_bytes.decode("utf-8").split("\n")
+    tgt_lines = tgt_bytes.decode("utf-8").split("\n")
+    texts = [normalize(s) + "\n" + normalize(t) for s, t in zip(src_lines, tgt_lines)]
+    return _lsh.band_keys(texts).tobytes()
+
+def _read_batches(source, target, batch_lines, skip=None):
+    """Yields the (line numbers, source bytes, target bytes) of batches of lines"""
+    with open(source, "rb") as src_fp, open(target, "rb") as tgt_fp:
+        lines = []
+        src_batch = []
+        tgt_batch = []
+        for line_no, (line_s, line_t) in enumerate(zip(src_fp, tgt_fp)):
+            if skip is not None and line_no in skip:
+                continue
+            lines.append(line_no)
+            src_batch.append(line_s.rstrip(b"\n"))
+            tgt_batch.append(line_t.rstrip(b"\n"))
+            if len(src_batch) >= batch_lines:
+                yield np.array(lines, dtype=np.int64), b"\n".join(src_batch), b"\n".join(tgt_batch)
+                lines = []
+                src_batch = []
+                tgt_batch = []
+        if len(src_batch) > 0:
+            yield np.array(lines, dtype=np.int64), b"\n".join(src_batch), b"\n".join(tgt_batch)
+
+def find_near_duplicates(source, target, num_perm=64, bands=8, shingle_size=5, seed=1,
+                         workers=None, batch_lines=2000, memory_limit=1024 * 1024 * 1024, skip=None):
+    """Returns (LineSet of near-duplicate line numbers, number of collapsed clusters).
+    Lines in skip (e.g. a LineSet of exact duplicates) are ignored, as if they were removed.
+    Band keys are remembered up to memory_limit; past that, lines are still
+    compared to the pairs seen so far, but new pairs are not remembered."""
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    # Band key -> line number of the first pair of its cluster
+    table = FingerprintTable(64, values=True)
+    frozen = False
+    duplicates = LineSet()
+    clusters = LineSet()
+
+    def add_keys(lines, keys):
+        """Look up and add the band keys of a batch of lines at once. A line joins
+        the cluster of the first line of its band keys (the smallest one, if they
+        belong to several), as if lines were added one at a time."""
+        nonlocal frozen
+        keys = np.frombuffer(keys, dtype=np.uint64)
+        rows = np.repeat(np.arange(len(lines)), bands)
+        found, values = table.get([keys])
+
+        # Keys seen in previous batches
+        known = found.reshape(-1, bands)
+        base = np.where(known, values.reshape(-1, bands).astype(np.int64), lines[:, None]).min(axis=1)
+        matched = known.any(axis=1)
+
+        # Keys first seen in this batch belong to the first line that has them
+        new = np.flatnonzero(~found)
+        distinct, first, inverse = np.unique(keys[new], return_index=True, return_inverse=True)
+        owners = rows[new][first]
+        # Lines (from the start of the batch) whose keys are added
+        added = 0 if frozen else len(lines)
+        if not frozen:
+            while table.needs_grow(len(distinct)):
+                if table.grow_nbytes() > memory_limit:
+                    print(f"Near-duplicate index exceeds {memory_limit // (1024 * 1024)}MB, no longer adding new pairs")
+                    frozen = True
+                    room = (table.capacity * 2 - 1) // 3 - table.size
+                    added = int(np.sort(owners)[max(0, room)])
+                    break
+                table.grow()
+
+        owner = owners[inverse]
+        later = (owner < rows[new]) & (owner < added)
+        line_rows, owner_rows = rows[new][later], owner[later]
+        matched[line_rows] = True
+        # The cluster of a line depends on the clusters of the earlier lines it
+        # matches: propagate them until they no longer change
+        cluster = base
+        while len(line_rows) > 0:
+            joined = base.copy()
+            np.minimum.at(joined, line_rows, cluster[owner_rows])
+            if np.array_equal(joined, cluster):
+                break
+            cluster = joined
+        if added > 0:
+            keep = owners < added
+            table.add([distinct[keep]], cluster[owners[keep]].astype(np.uint64))
+
+        duplicates.update(lines[matched])
+        clusters.update(cluster[matched])
+
+    batches = _read_batches(source, target, batch_lines, skip)
+    if workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork"),
+                                 initializer=_init_worker, initargs=(num_perm, bands, shingle_size, seed)) as executor:
+            # Keep a bounded number of batches in flight, in order
+            pending = deque()
+            for lines, src_bytes, tgt_bytes in batches:
+                pending.append((lines, executor.submit(_band_keys, src_bytes, tgt_bytes)))
+                if len(pending) >= workers * 2:
+                    lines, keys = pending.popleft()
+                    add_keys(lines, keys.result())
+            while len(pending) > 0:
+                lines, keys = pending.popleft()
+                add_keys(lines, keys.result())
+    else:
+        _init_worker(num_perm, bands, shingle_size, seed)
+        for lines, src_bytes, tgt_bytes in batches:
+            add_keys(lines, _band_keys(src_bytes, tgt_bytes))
+
+    return duplicates, len(clusters)
@@ -1,8 +1,15 @@
 import torch
 import sys
 import math
+import json
+import random
+import inspect
 from onmt.constants import DefaultTokens
-from onmt.transforms import register_transform
+from onmt.transforms import register_transform, AVAILABLE_TRANSFORMS
+from onmt.transforms.transform import Transform, ObservableStats
+from onmt.transforms.misc import FilterTooLongStats
+import filters as filter_funcs
+import transforms as transform_funcs
 
 # From: https://github.com/OpenNMT/OpenNMT-py
 # MIT licensed
@@ -62,3 +69,279 @@ def sp_vocab_to_onmt_vocab(sp_vocab, onmt_vocab):
                     print(str(e))
 
     print(f"Wrote {onmt_vocab}")
+
+
+# Locomotive filters and transforms as OpenNMT-py transforms, so that they can
+# run on the fly in the dataloader workers of onmt_train (see train.py).
+# Every function of filters.py and transforms.py is registered as
+# locomotive_filter_<name> / locomotive_transform_<name>. Their arguments are read
+# per corpus from the JSON file given by the locomotive_spec option, which maps
+# corpus names to their source definition (from, to, filters, transforms, augmenters).
+# Corpora that don't use a function are passed through.
+# Augmenters are applied by locomotive_augment, which adds the augmented pairs
+# of each example with the probability set for each augmenter.
+
+# Filters that select lines by position, which can't be applied on the fly
+POSITIONAL_FILTERS = ("top", "excerpt")
+
+def _entry_name(entry):
+    return list(entry.keys())[0] if isinstance(entry, dict) else entry
+
+def transform_names(source):
+    """OpenNMT transforms of the filters and transforms of a source, in order"""
+    names = []
+    for f in source['filters']:
+        if _entry_name(f) not in POSITIONAL_FILTERS:
+            names.append(f"locomotive_filter_{_entry_name(f)}")
+    for t in source['transforms']:
+        names.append(f"locomotive_transform_{_entry_name(t)}")
+    if len(source.get('augmenters', [])) > 0:
+        names.append("locomotive_augment")
+    return list(dict.fromkeys(names))
+
+def _tokens(line):
+    # Examples hold lists of (whitespace separated) tokens
+    return line if isinstance(line, str) else " ".join(line)
+
+class LocomotiveFilterStats(ObservableStats):
+    """Number of pairs removed by each filter"""
+
+    __slots__ = ["filtered"]
+
+    def __init__(self, name=None, count=0):
+        self.filtered = {} if name is None else {name: count}
+
+    def update(self, other, **kwargs):
+        for k, v in other.filtered.items():
+            self.filtered[k] = self.filtered.get(k, 0) + v
+
+    def __str__(self):
+        return "{}({})".format(self.name(), ", ".join(f"{k}={v}" for k, v in self.filtered.items()))
+
+class LocomotiveAugmentStats(ObservableStats):
+    """Number of pairs seen and added by each augmenter"""
+
+    __slots__ = ["augmented"]
+
+    def __init__(self, name=None, seen=0, added=0):
+        self.augmented = {} if name is None else {name: [seen, added]}
+
+    def update(self, other, **kwargs):
+        for k, (seen, added) in other.augmented.items():
+            counts = self.augmented.setdefault(k, [0, 0])
+            counts[0] += seen
+            counts[1] += added
+
+    def __str__(self):
+        rates = [f"{k}={added}/{seen} ({added / max(seen, 1):.1%})" for k, (seen, added) in self.augmented.items()]
+        return "{}({})".format(self.name(), ", ".join(rates))
+
+class _LocomotiveTransform(Transform):
+    # Set by each registered subclass
+    kind = None
+    func_name = None
+
+    @classmethod
+    def add_options(cls, parser):
+        # Shared by all the Locomotive transforms, so only added once
+        if cls is not _registered[0]:
+            return
+        group = parser.add_argument_group("Transform/Locomotive")
+        group.add("--locomotive_spec", "-locomotive_spec", type=str, default=None,
+                  help="JSON file with the source definition of each corpus")
+
+    def _parse_opts(self):
+        self.spec_path = self.opts.locomotive_spec
+
+    def warm_up(self, vocabs=None):
+        super().warm_up(None)
+        import data
+        spec = {}
+        if self.spec_path is not None:
+            with open(self.spec_path, "r", encoding="utf-8") as f:
+                spec = json.loads(f.read())
+
+        # Corpus name -> functions (with their arguments) of this transform
+        self.funcs = {}
+        for cid, source in spec.items():
+            if self.kind == "filter":
+                entries = [f for f in source['filters'] if _entry_name(f) == self.func_name]
+                flmodel = None
+                if self.func_name == "fast_lang" and len(entries) > 0:
+                    flmodel = data.load_fasttext(data.get_fasttext_path())
+                funcs = data.get_filters({**source, 'filters': entries}, flmodel)
+            else:
+                entries = [t for t in source['transforms'] if _entry_name(t) == self.func_name]
+                funcs = data.get_transforms({**source, 'transforms': entries})
+            if len(funcs) > 0:
+                self.funcs[cid] = funcs
+
+    def apply(self, example, is_train=False, stats=None, **kwargs):
+        batch = self.batch_apply([(example, self, kwargs.get('corpus_name'))], is_train, stats, **kwargs)
+        return batch[0][0] if len(batch) > 0 else None
+
+    def batch_apply(self, batch, is_train=False, stats=None, **kwargs):
+        by_corpus = {}
+        for i, (example, _, cid) in enumerate(batch):
+            if cid in self.funcs and example.get('tgt') is not None:
+                by_corpus.setdefault(cid, []).append(i)
+
+        removed = set()
+        for cid, indices in by_corpus.items():
+            srcs = [_tokens(batch[i][0]['src']) for i in indices]
+            tgts = [_tokens(batch[i][0]['tgt']) for i in indices]
+            for func in self.funcs[cid]:
+                if self.kind == "filter":
+                    remove = func.batch(srcs, tgts)
+                    kept = [k for k, r in enumerate(remove) if not r]
+                    if stats is not None and len(kept) < len(indices):
+                        stats.update(LocomotiveFilterStats(self.func_name, len(indices) - len(kept)))
+                    removed.update(i for i, r in zip(indices, remove) if r)
+                    indices = [indices[k] for k in kept]
+                    srcs = [srcs[k] for k in kept]
+                    tgts = [tgts[k] for k in kept]
+                else:
+                    pairs = [func(src, tgt) for src, tgt in zip(srcs, tgts)]
+                    srcs = [src for src, tgt in pairs]
+                    tgts = [tgt for src, tgt in pairs]
+            if self.kind == "transform":
+                for i, src, tgt in zip(indices, srcs, tgts):
+                    batch[i][0]['src'] = src.split()
+                    batch[i][0]['tgt'] = tgt.split()
+
+        return [(example, self, cid) for i, (example, _, cid) in enumerate(batch) if i not in removed]
+
+class LocomotiveAugmentTransform(_LocomotiveTransform):
+    kind = "augmenter"
+
+    def warm_up(self, vocabs=None):
+        Transform.warm_up(self, None)
+        import data
+        spec = {}
+        if self.spec_path is not None:
+            with open(self.spec_path, "r", encoding="utf-8") as f:
+                spec = json.loads(f.read())
+
+        # Corpus name -> (augmenter, probability)
+        self.funcs = {}
+        for cid, source in spec.items():
+            augmenters = data.get_augmenters(source)
+            probabilities = [augmenter_probability(a) for a in source.get('augmenters', [])]
+            if len(augmenters) > 0:
+                self.funcs[cid] = list(zip(augmenters, probabilities))
+
+    def batch_apply(self, batch, is_train=False, stats=None, **kwargs):
+        out = []
+        counts = {}
+        for example, _, cid in batch:
+            out.append((example, self, cid))
+            if cid not in self.funcs or example.get('tgt') is None:
+                continue
+            src, tgt = _tokens(example['src']), _tokens(example['tgt'])
+            for func, probability in self.funcs[cid]:
+                seen_added = counts.setdefault(func.__name__, [0, 0])
+                seen_added[0] += 1
+                if probability < 1 and random.random() >= probability:
+                    continue
+                for a_src, a_tgt in func(src, tgt):
+                    augmented = dict(example)
+                    for side, line in (('src', a_src), ('tgt', a_tgt)):
+                        augmented[side] = line.split()
+                        if f"{side}_original" in augmented:
+                            augmented[f"{side}_original"] = line.split()
+                    out.append((augmented, self, cid))
+                    seen_added[1] += 1
+
+        if stats is not None:
+            for name, (seen, added) in counts.items():
+                stats.update(LocomotiveAugmentStats(name, seen, added))
+        return out
+
+def augmenter_probability(entry):
+    """Probability with which an augmenter is applied to a pair (1 unless set)"""
+    return entry[_entry_name(entry)].get('probability', 1.0) if isinstance(entry, dict) else 1.0
+
+class LocomotiveSPCacheTransform(Transform):
+    """Pieces of the lines of a corpus, read from its SentencePiece id cache
+    (see spcache.py) instead of encoding them, and filtered by their cached
+    lengths. Replaces the sentencepiece and filtertoolong transforms."""
+
+    @classmethod
+    def add_options(cls, parser):
+        group = parser.add_argument_group("Transform/LocomotiveSPCache")
+        group.add("--locomotive_sp_cache", "-locomotive_sp_cache", type=str, default=None,
+                  help="Directory of the SentencePiece id cache")
+        group.add("--locomotive_sp_cache_corpus", "-locomotive_sp_cache_corpus", type=str, default="corpus_1",
+                  help="Corpus whose lines are cached")
+
+    def _parse_opts(self):
+        self.cache_dir = self.opts.locomotive_sp_cache
+        self.corpus = self.opts.locomotive_sp_cache_corpus
+        self.src_seq_length = self.opts.src_seq_length
+        self.tgt_seq_length = self.opts.tgt_seq_length
+
+    def warm_up(self, vocabs=None):
+        super().warm_up(None)
+        import sentencepiece as spm
+        from spcache import SPCache
+        self.cache = SPCache(self.cache_dir)
+        self.processor = spm.SentencePieceProcessor(model_file=self.opts.src_subword_model)
+        self.pieces = [self.processor.id_to_piece(i) for i in range(self.processor.get_piece_size())]
+
+    def apply(self, example, is_train=False, stats=None, **kwargs):
+        line = example.get('cid_line_number')
+        if kwargs.get('corpus_name', self.corpus) == self.corpus and line is not None and line < len(self.cache):
+            # Same limits as filtertoolong (the target gets BOS/EOS)
+            if self.cache.length(line, 0) > self.src_seq_length or self.cache.length(line, 1) > self.tgt_seq_length - 2:
+                if stats is not None:
+                    stats.update(FilterTooLongStats())
+                return None
+            example['src'] = [self.pieces[i] for i in self.cache.line_ids(line, 0)]
+            example['tgt'] = [self.pieces[i] for i in self.cache.line_ids(line, 1)]
+            return example
+
+        # Not cached: encode
+        for side in ('src', 'tgt'):
+            if example.get(side) is not None:
+                example[side] = self.processor.encode(_tokens(example[side]), out_type=str)
+        if len(example['src']) > self.src_seq_length or (example.get('tgt') is not None and len(example['tgt']) > self.tgt_seq_length - 2):
+            if stats is not None:
+                stats.update(FilterTooLongStats())
+            return None
+        return example
+
+    def batch_apply(self, batch, is_train=False, stats=None, **kwargs):
+        out = []
+        for example, _, cid in batch:
+            example = self.apply(example, is_train, stats, **{**kwargs, 'corpus_name': cid})
+            if example is not None:
+                out.append((example, self, cid))
+        return out
+
+_registered = []
+
+def _register(kind, module):
+    for name, func in inspect.getmembers(module, inspect.isfunction):
+        if name.startswith("_") or func.__module__ != module.__name__:
+            continue
+        transform_name = f"locomotive_{kind}_{name}"
+        cls = type(f"Locomotive_{kind}_{name}", (_LocomotiveTransform,),
+                   {'kind': kind, 'func_name': name, '__module__': __name__})
+        # Module level, so that transforms can be pickled to the dataloader workers
+        globals()[cls.__name__] = cls
+        _registered.append(cls)
+        # This module is imported again by workers that don't fork
+        if transform_name not in AVAILABLE_TRANSFORMS:
+            register_transform(name=transform_name)(cls)
+
+_register("filter", filter_funcs)
+_register("transform", transform_funcs)
+if "locomotive_augment" not in AVAILABLE_TRANSFORMS:
+    register_transform(name="locomotive_augment")(LocomotiveAugmentTransform)
+if "locomotive_sp_cache" not in AVAILABLE_TRANSFORMS:
+    register_transform(name="locomotive_sp_cache")(LocomotiveSPCacheTransform)
+
+if __name__ == "__main__":
+    # onmt_train, with the Locomotive transforms registered
+    from onmt.bin.train import main
+    main()
@@ -0,0 +1,218 @@
+import os
+import sys
+import json
+import argparse
+import resource
+import torch
+import torch.nn.functional as F
+from onmt.bin.train import _get_parser
+from onmt.utils.parse import ArgumentParser
+from onmt.transforms import get_transforms_cls
+from onmt.train_single import prepare_transforms_vocabs
+from onmt.model_builder import build_model
+from onmt.utils.optimizers import Optimizer
+import onmt_tools # Registers the Locomotive transforms
+
+'''
+Probe of the largest batch_size that fits in memory, before onmt_train.
+
+The model of an onmt_train config is built on the first GPU (or the CPU), and
+a forward/backward pass and an optimizer step are run on batches of random
+tokens of the longest sequences that can be trained on (src_seq_length,
+tgt_seq_length). The number of sentences of a batch is doubled, then binary
+searched, for the largest one whose peak memory stays within the memory of the
+device (free GPU memory, or available RAM on the CPU), minus a headroom.
+On the CPU, a trial that exhausts the memory gets the process killed rather
+than raising an error: batches whose memory, extrapolated from the previous
+trials, exceeds the limit are not tried, and the probe runs as a separate
+process (see train.py).
+'''
+
+# Ids below are special tokens
+FIRST_TOKEN = 4
+
+def _available_ram():
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+
+def _reset_peak_rss():
+    """Reset the peak RSS of the process (Linux only). Returns False if it can't."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+def _peak_rss():
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+def _is_oom(e):
+    return isinstance(e, MemoryError) or "out of memory" in str(e) or "can't allocate memory" in str(e)
+
+def load_opts(config_path):
+    """Validated onmt_train options of a config file"""
+    opt, unknown = _get_parser().parse_known_args(["-config", config_path])
+    ArgumentParser.validate_train_opts(opt)
+    ArgumentParser.update_model_opts(opt)
+    ArgumentParser.validate_model_opts(opt)
+    ArgumentParser.validate_prepare_opts(opt)
+    return opt
+
+class Probe:
+    def __init__(self, opt, headroom=0.1, memory_limit=None):
+        self.gpu = len(opt.gpu_ranks) > 0 and torch.cuda.is_available()
+        self.device = torch.device("cuda", 0) if self.gpu else torch.device("cpu")
+        if self.gpu:
+            torch.cuda.set_device(0)
+            budget = torch.cuda.mem_get_info(0)[0]
+        else:
+            budget = _available_ram()
+            _reset_peak_rss()
+            self.base_rss = _peak_rss()
+        if memory_limit is not None:
+            budget = min(budget, memory_limit)
+        self.budget = int(budget * (1 - headroom))
+
+        vocabs = prepare_transforms_vocabs(opt, get_transforms_cls(opt._all_transform))
+        self.vocab_size = len(vocabs['tgt'])
+        self.model = build_model(opt, opt, vocabs, None, 0 if self.gpu else -1)
+        self.model.train()
+        self.optim = Optimizer.from_opt(self.model, opt)
+        # Sentences are filtered on their length in pieces (see filtertoolong):
+        # targets have at most tgt_seq_length - 2 pieces, then get <s> and </s>
+        self.src_len = opt.src_seq_length
+        self.tgt_len = opt.tgt_seq_length
+        self.batch_type = opt.batch_type
+        if opt.batch_size_multiple is not None:
+            self.multiple = opt.batch_size_multiple
+        else:
+            self.multiple = 8 if opt.model_dtype == "fp16" else 1
+        # (sentences, peak memory) of the batches that fit
+        self.fitting = []
+
+    def sentences(self, batch_size):
+        """Number of sentences of a batch of batch_size (as onmt_train counts it)"""
+        if self.batch_type == "tokens":
+            return max(1, batch_size // max(self.src_len, self.tgt_len))
+        return batch_size
+
+    def batch_size(self, sentences):
+        if self.batch_type == "tokens":
+            return sentences * max(self.src_len, self.tgt_len)
+        return sentences
+
+    def measure(self, sentences):
+        """Peak memory of a training step on a batch of sentences (None if it runs out of memory)"""
+        if self.gpu:
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats()
+        else:
+            _reset_peak_rss()
+        try:
+            src = torch.randint(FIRST_TOKEN, self.vocab_size, (sentences, self.src_len, 1), device=self.device)
+            tgt = torch.randint(FIRST_TOKEN, self.vocab_size, (sentences, self.tgt_len, 1), device=self.device)
+            src_len = torch.full((sentences,), self.src_len, dtype=torch.long, device=self.device)
+            self.optim.zero_grad(set_to_none=True)
+            with torch.cuda.amp.autocast(enabled=self.optim.amp):
+                out, attns = self.model(src, tgt, src_len)
+                scores = self.model.generator(out.reshape(-1, out.size(2)))
+                loss = F.cross_entropy(scores.float(), tgt[:, 1:, 0].reshape(-1), reduction="sum")
+            self.optim.backward(loss / sentences)
+            self.optim.step()
+            del src, tgt, src_len, out, attns, scores, loss
+        except (RuntimeError, MemoryError) as e:
+            if not _is_oom(e):
+                raise
+            return None
+        finally:
+            self.optim.zero_grad(set_to_none=True)
+        if self.gpu:
+            return torch.cuda.max_memory_reserved()
+        return _peak_rss() - self.base_rss
+
+    def predict(self, sentences):
+        """Peak memory of a batch, extrapolated from the two largest batches
+        that fit (None without them)"""
+        if len(self.fitting) < 2:
+            return None
+        (n1, m1), (n2, m2) = sorted(self.fitting)[-2:]
+        return m2 + (sentences - n2) * max(0, m2 - m1) / (n2 - n1)
+
+    def fits(self, sentences):
+        predicted = self.predict(sentences)
+        if predicted is not None and predicted > self.budget:
+            print(f"batch_size {self.batch_size(sentences)}: ~{predicted / 1024 / 1024:.0f} MB (not tried)")
+            return False
+        peak = self.measure(sentences)
+        ok = peak is not None and peak <= self.budget
+        print(f"batch_size {self.batch_size(sentences)}: " +
+              ("out of memory" if peak is None else f"{peak / 1024 / 1024:.0f} MB") +
+              f" ({'fits' if ok else 'does not fit'} in {self.budget / 1024 / 1024:.0f} MB)")
+        if ok:
+            self.fitting.append((sentences, peak))
+        return ok
+
+    def search(self, max_batch_size):
+        """Largest batch_size up to max_batch_size that fits (0 if none does)"""
+        top = max(1, self.sentences(max_batch_size) // self.multiple)
+        lo, hi = 0, top + 1
+        units = 1
+        while lo < top:
+            if not self.fits(units * self.multiple):
+                hi = units
+                break
+            lo = units
+            units = min(units * 2, top)
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if self.fits(mid * self.multiple):
+                lo = mid
+            else:
+                hi = mid
+        return self.batch_size(lo * self.multiple)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Find the largest batch_size of an onmt_train config that fits in memory')
+    parser.add_argument('--config',
+        type=str,
+        required=True,
+        help='Path to the onmt_train config.yml')
+    parser.add_argument('--output',
+        type=str,
+        required=True,
+        help='Path of the .json file to write the result to')
+    parser.add_argument('--max-batch-size',
+        type=int,
+        required=True,
+        help='Largest batch_size to try')
+    parser.add_argument('--headroom',
+        type=float,
+        default=0.1,
+        help='Fraction of the memory to keep free. Default: %(default)s')
+    parser.add_argument('--memory-mb',
+        type=int,
+        default=None,
+        help='Memory limit, in MB (default: the memory of the device)')
+    args = parser.parse_args()
+
+    opt = load_opts(args.config)
+    probe = Probe(opt, headroom=args.headroom, memory_limit=args.memory_mb * 1024 * 1024 if args.memory_mb is not None else None)
+    batch_size = probe.search(args.max_batch_size)
+    with open(args.output, "w", encoding="utf-8") as f:
+        f.write(json.dumps({'batch_size': batch_size, 'device': str(probe.device), 'budget': probe.budget}))
+    print(f"Largest batch_size: {batch_size}")
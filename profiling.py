@@ -0,0 +1,136 @@
+import math
+import json
+
+'''
+Low overhead profiling of the merge pipeline.
+
+Each stage of a source (reading, every filter, transform and augmenter, writing)
+is timed once per batch of lines rather than once per line. The time per line of
+each batch is added to a histogram with 4 buckets per power of two, from which
+percentiles are estimated. Profiles are plain dicts, so that they can be
+returned by worker processes and merged across the shards of a source.
+'''
+
+BUCKETS_PER_OCTAVE = 4
+
+def _bucket(seconds_per_line):
+    ns = seconds_per_line * 1e9
+    if ns < 1:
+        return 0
+    return int(math.log2(ns) * BUCKETS_PER_OCTAVE) + 1
+
+def _bucket_ns(bucket):
+    """Upper bound of a bucket, in nanoseconds per line"""
+    return 2 ** (bucket / BUCKETS_PER_OCTAVE)
+
+class Profile:
+    def __init__(self):
+        self.seconds = 0.0
+        self.lines = 0
+        self.stages = {}
+
+    def record(self, kind, name, seconds, lines, rejects=0):
+        """Record a call of a stage processing lines in seconds"""
+        key = f"{kind}:{name}"
+        stage = self.stages.get(key)
+        if stage is None:
+            stage = self.stages[key] = {'kind': kind, 'name': name, 'calls': 0, 'lines': 0, 'rejects': 0,
+                                        'seconds': 0.0, 'histogram': {}}
+        stage['calls'] += 1
+        stage['lines'] += lines
+        stage['rejects'] += rejects
+        stage['seconds'] += seconds
+        if lines > 0:
+            b = _bucket(seconds / lines)
+            stage['histogram'][b] = stage['histogram'].get(b, 0) + lines
+
+    def to_dict(self):
+        return {'seconds': self.seconds, 'lines': self.lines, 'stages': self.stages}
+
+def merge_profiles(a, b):
+    """Merge two profile dicts (e.g. of two shards of the same source)"""
+    if a is None:
+        return b
+    out = {'seconds': a['seconds'] + b['seconds'], 'lines': a['lines'] + b['lines'], 'stages': {}}
+    for key in list(a['stages']) + [k for k in b['stages'] if k not in a['stages']]:
+        sa = a['stages'].get(key)
+        sb = b['stages'].get(key)
+        if sa is None or sb is None:
+            out['stages'][key] = sa or sb
+            continue
+        histogram = dict(sa['histogram'])
+        for k, v in sb['histogram'].items():
+            histogram[k] = histogram.get(k, 0) + v
+        out['stages'][key] = {'kind': sa['kind'], 'name': sa['name'],
+                              'calls': sa['calls'] + sb['calls'],
+                              'lines': sa['lines'] + sb['lines'],
+                              'rejects': sa['rejects'] + sb['rejects'],
+                              'seconds': sa['seconds'] + sb['seconds'],
+                              'histogram': histogram}
+    return out
+
+def percentile(histogram, p):
+    """Estimated p-th percentile of the time per line, in microseconds"""
+    total = sum(histogram.values())
+    if total == 0:
+        return 0.0
+    seen = 0
+    for b in sorted(histogram, key=int):
+        seen += histogram[b]
+        if seen >= total * p / 100:
+            return _bucket_ns(int(b)) / 1000
+    return 0.0
+
+def stage_report(stage):
+    seconds = stage['seconds']
+    return {
+        'kind': stage['kind'],
+        'name': stage['name'],
+        'calls': stage['calls'],
+        'lines': stage['lines'],
+        'rejects': stage['rejects'],
+        'seconds': round(seconds, 6),
+        'lines_per_sec': round(stage['lines'] / seconds, 1) if seconds > 0 else None,
+        'p50_us': round(percentile(stage['histogram'], 50), 3),
+        'p90_us': round(percentile(stage['histogram'], 90), 3),
+        'p99_us': round(percentile(stage['histogram'], 99), 3),
+    }
+
+def source_report(name, profile, cached=False):
+    if cached or profile is None:
+        return {'source': name, 'cached': cached, 'lines': 0, 'seconds': 0.0, 'lines_per_sec': None, 'stages': []}
+    seconds = profile['seconds']
+    return {
+        'source': name,
+        'cached': False,
+        'lines': profile['lines'],
+        'seconds': round(seconds, 6),
+        'lines_per_sec': round(profile['lines'] / seconds, 1) if seconds > 0 else None,
+        'stages': [stage_report(s) for s in profile['stages'].values()],
+    }
+
+def write_report(path, report):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(json.dumps(report, indent=4))
+
+def format_table(report):
+    """Compact text table of a list of source reports"""
+    rows = [("stage", "calls", "lines", "rejects", "time (s)", "lines/s", "p50 us", "p99 us")]
+    for s in report:
+        if s['cached']:
+            rows.append((s['source'] + " (cached)", "", "", "", "", "", "", ""))
+            continue
+        rows.append((s['source'], "", str(s['lines']), "", f"{s['seconds']:.2f}",
+                     f"{s['lines_per_sec']:.0f}" if s['lines_per_sec'] else "", "", ""))
+        for st in s['stages']:
+            rows.append(("  " + st['kind'] + " " + st['name'], str(st['calls']), str(st['lines']),
+                         str(st['rejects']) if st['kind'] == "filter" else "",
+                         f"{st['seconds']:.2f}",
+                         f"{st['lines_per_sec']:.0f}" if st['lines_per_sec'] else "",
+                         f"{st['p50_us']:.2f}", f"{st['p99_us']:.2f}"))
+
+    widths = [max(len(r[c]) for r in rows) for c in range(len(rows[0]))]
+    lines = []
+    for r in rows:
+        lines.append("  ".join(r[0].ljust(widths[0]) if c == 0 else r[c].rjust(widths[c]) for c in range(len(r))).rstrip())
+    return "\n".join(lines)
@@ -0,0 +1,97 @@
+import math
+import itertools
+import numpy as np
+import archive
+import lineindex
+
+'''
+Stratified reservoir sampling of text files, used to build the input of
+SentencePiece training.
+
+Each input file (a stratum: one side of a source) gets a share of the sample
+proportional to its weight, and is sampled in a single streaming pass with a
+reservoir (Algorithm L, which skips over lines instead of drawing a random
+number for each of them). Lines are counted first: files with fewer lines
+than their share are included as a whole, and the rest of their share is split
+among the other files, proportionally to their weights.
+'''
+
+def _uniform(rng):
+    """Uniform random number in (0, 1)"""
+    u = rng.random()
+    while u == 0:
+        u = rng.random()
+    return u
+
+def reservoir(lines, k, rng):
+    """Uniform sample of k items of an iterator (all of them if it has fewer)"""
+    sample = list(itertools.islice(lines, k))
+    if len(sample) < k or k == 0:
+        return sample
+
+    w = math.exp(math.log(_uniform(rng)) / k)
+    while True:
+        skip = int(math.floor(math.log(_uniform(rng)) / math.log(1 - w)))
+        item = next(itertools.islice(lines, skip, skip + 1), None)
+        if item is None:
+            return sample
+        sample[int(rng.integers(k))] = item
+        w *= math.exp(math.log(_uniform(rng)) / k)
+
+def _proportional(weights, size):
+    total = sum(weights)
+    exact = [size * w / total for w in weights]
+    counts = [int(e) for e in exact]
+    # Largest remainders get the lines left
+    for i in sorted(range(len(weights)), key=lambda i: counts[i] - exact[i])[:size - sum(counts)]:
+        counts[i] += 1
+    return counts
+
+def quotas(weights, size, caps=None):
+    """Split size among strata proportionally to their weights. With caps (e.g.
+    their number of lines), strata get at most their cap, and what they can't
+    take is split among the others"""
+    if caps is None:
+        return _proportional(weights, size)
+    counts = [0] * len(weights)
+    left = [i for i in range(len(weights)) if caps[i] > 0]
+    while len(left) > 0:
+        total = sum(weights[i] for i in left)
+        full = [i for i in left if size * weights[i] / total >= caps[i]]
+        if len(full) == 0:
+            for i, k in zip(left, _proportional([weights[i] for i in left], size)):
+                counts[i] = k
+            break
+        for i in full:
+            counts[i] = caps[i]
+            size -= caps[i]
+        left = [i for i in left if i not in full]
+    return counts
+
+def count_lines(path):
+    if archive.is_stream(path):
+        return archive.count_lines(path)
+    return lineindex.load(path).count
+
+def stratified_sample(inputs, size, out_path, seed=None):
+    """Write a sample of size lines of inputs, a list of (path, weight),
+    to out_path (in random order). Returns the number of lines written, which
+    is less than size when the inputs have fewer (non-empty) lines."""
+    rng = np.random.default_rng(seed)
+    counts = [count_lines(path) for path, weight in inputs]
+    sample = []
+    for (path, weight), k in zip(inputs, quotas([w for p, w in inputs], size, counts)):
+        f = archive.open_stream(path) if archive.is_stream(path) else open(path, "rb")
+        with f:
+            lines = (l for l in f if len(l.strip()) > 0)
+            stratum = reservoir(lines, k, rng)
+        print(f"Sampled {len(stratum)} lines of {path}")
+        sample += stratum
+    if len(sample) < size:
+        print(f"Sampled {len(sample)} lines instead of {size}: the inputs don't have enough (non-empty) lines")
+
+    with open(out_path, "wb") as f:
+        for i in rng.permutation(len(sample)).tolist():
+            line = sample[i]
+            f.write(line if line.endswith(b"\n") else line + b"\n")
+    return len(sample)
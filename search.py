@@ -0,0 +1,186 @@
+import os
+import re
+import mmap
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import lineindex
+import archive
+
+'''
+Search of (source, target) files, used by find.py.
+
+Files are split in chunks of aligned lines (using their line index), which are
+searched on a process pool. Chunks are searched as raw bytes when it's safe:
+ASCII patterns are matched against bytes.lower() of the chunk, which gives
+the same result as str.lower() unless the chunk contains one of the two
+non-ASCII characters that lowercase to ASCII. Other chunks are decoded and
+lowercased as a whole. Only the lines that may match are then decoded and
+checked one by one, with the same rules as a line by line scan.
+'''
+
+CHUNK_SIZE = 16 * 1024 * 1024
+
+# Non-ASCII characters whose lowercase contains ASCII characters (İ, K)
+_LOWER_TO_ASCII = ("İ".encode("utf-8"), "K".encode("utf-8"))
+
+class Matcher:
+    """Matches lines against any of several patterns (substrings or regular expressions).
+    Lines are lowercased; with exact, the whole (stripped) line must match."""
+
+    def __init__(self, patterns, regex=False, exact=False):
+        self.regex = regex
+        self.exact = exact
+        if regex:
+            self.patterns = [re.compile(p) for p in patterns]
+            source = "|".join(f"(?:{p})" for p in patterns)
+        else:
+            self.patterns = [p.lower() for p in patterns]
+            source = "|".join(re.escape(p) for p in self.patterns)
+        self.ascii = all(p.isascii() for p in patterns)
+        self.str_rx = re.compile(source, re.MULTILINE)
+        self.bytes_rx = re.compile(source.encode("utf-8"), re.MULTILINE) if self.ascii else None
+
+    def match(self, line_s):
+        line_s = line_s.lower()
+        if self.exact:
+            line_s = line_s.strip()
+            if self.regex:
+                return any(p.fullmatch(line_s) for p in self.patterns)
+            return line_s in self.patterns
+        if self.regex:
+            return any(p.search(line_s) for p in self.patterns)
+        return any(p in line_s for p in self.patterns)
+
+    def find_lines(self, data):
+        """0-based indices of the lines of data that match"""
+        if self.bytes_rx is not None and (data.isascii() or
+                (not self.regex and not any(c in data for c in _LOWER_TO_ASCII))):
+            # Byte offsets are the same in data and data.lower()
+            rx, text, newline = self.bytes_rx, data.lower(), b"\n"
+            lines = None
+        else:
+            rx, text, newline = self.str_rx, data.decode("utf-8").lower(), "\n"
+            lines = data.split(b"\n")
+
+        found = []
+        pos = 0
+        line = 0
+        while True:
+            m = rx.search(text, pos)
+            if m is None:
+                break
+            line += text.count(newline, pos, m.start())
+            # Continue from the next line, so that a match spanning two
+            # lines doesn't hide a match in the second one
+            start = text.rfind(newline, 0, m.start()) + 1
+            pos = text.find(newline, m.start())
+            end = len(text) if pos == -1 else pos
+            line_b = data[start:end] if lines is None else lines[line]
+            if self.match(line_b.decode("utf-8")):
+                found.append(line)
+            if pos == -1:
+                break
+            pos += 1
+            line += 1
+        return found
+
+def read_line(mm, index, n):
+    return mm[index.line_offset(n):index.line_offset(n + 1)]
+
+def read_pairs(source, target, line_numbers):
+    """(line number, source line, target line) of 0-based line numbers"""
+    src_index = lineindex.load(source)
+    tgt_index = lineindex.load(target)
+    pairs = []
+    with open(source, "rb") as src_fp, open(target, "rb") as tgt_fp:
+        src_mm = mmap.mmap(src_fp.fileno(), 0, access=mmap.ACCESS_READ)
+        tgt_mm = mmap.mmap(tgt_fp.fileno(), 0, access=mmap.ACCESS_READ)
+        for n in line_numbers:
+            pairs.append((n + 1, read_line(src_mm, src_index, n).decode("utf-8"), read_line(tgt_mm, tgt_index, n).decode("utf-8")))
+        src_mm.close()
+        tgt_mm.close()
+    return pairs
+
+def chunks(source, target, chunk_size=CHUNK_SIZE):
+    """(first line, number of lines) of chunks of about chunk_size bytes of the source"""
+    index = lineindex.load(source)
+    lineindex.load(target)
+    first = 0
+    begin = 0
+    while begin < index.size:
+        nxt = index.next_line(begin + chunk_size - 1)
+        if nxt is None:
+            yield first, None
+            break
+        yield first, nxt[0] - first
+        first, begin = nxt
+
+def scan_chunk(source, target, first, count, matcher):
+    """Matching pairs of lines [first, first + count) (until the end if count is None)"""
+    src_index = lineindex.load(source)
+    tgt_index = lineindex.load(target)
+    matches = set()
+    for path, index in ((source, src_index), (target, tgt_index)):
+        begin = index.line_offset(first)
+        end = index.line_offset(first + count) if count is not None else index.size
+        if end <= begin:
+            continue
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            data = mm[begin:end]
+            mm.close()
+        matches.update(first + i for i in matcher.find_lines(data))
+    return read_pairs(source, target, sorted(matches))
+
+def scan(source, target, matcher, workers=None, chunk_size=CHUNK_SIZE):
+    """Yields the (line number, source line, target line) pairs
+    where the source or the target match, in order"""
+    if workers is None:
+        workers = os.cpu_count() or 1
+    tasks = chunks(source, target, chunk_size)
+    if workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+            # Keep a bounded number of chunks in flight, in order
+            pending = deque()
+            for first, count in tasks:
+                pending.append(executor.submit(scan_chunk, source, target, first, count, matcher))
+                if len(pending) >= workers * 2:
+                    yield from pending.popleft().result()
+            while len(pending) > 0:
+                yield from pending.popleft().result()
+    else:
+        for first, count in tasks:
+            yield from scan_chunk(source, target, first, count, matcher)
+
+def scan_stream(source, target, matcher, chunk_size=CHUNK_SIZE):
+    """Same as scan, for files that are read as streams (see archive.py)"""
+    with archive.open_stream(source) as src_fp, archive.open_stream(target) as tgt_fp:
+        first = 0
+        while True:
+            src_lines = src_fp.readlines(chunk_size)
+            if len(src_lines) == 0:
+                break
+            tgt_lines = [tgt_fp.readline() for l in src_lines]
+            matches = set(matcher.find_lines(b"".join(src_lines)))
+            matches.update(matcher.find_lines(b"".join(tgt_lines)))
+            for i in sorted(matches):
+                yield first + i + 1, src_lines[i].decode("utf-8"), tgt_lines[i].decode("utf-8")
+            first += len(src_lines)
+
+def index_search(source, target, matcher, cache_dir):
+    """Same as scan, using the trigram index of the files
+    (only for substring patterns)"""
+    from trigram import TrigramIndex
+    matches = set()
+    for path in (source, target):
+        index = TrigramIndex(path, cache_dir)
+        index.update()
+        seen = set()
+        for pattern in matcher.patterns:
+            for first_line, block in index.candidate_blocks(pattern):
+                if first_line in seen:
+                    continue
+                seen.add(first_line)
+                matches.update(first_line + i for i in matcher.find_lines(block))
+    return read_pairs(source, target, sorted(matches))
@@ -0,0 +1,154 @@
+import os
+import tempfile
+import numpy as np
+from dedup import DEDUP_KEYS, Deduplicator, fingerprint, dedup_data
+
+'''
+External-memory shuffle of (source, target) pairs.
+
+Pairs are scattered into K temporary bucket files (source and target lines
+interleaved), then each bucket is loaded, shuffled in memory and written out,
+one bucket at a time. K is chosen so that a bucket fits in memory_limit.
+Bucket assignments and shuffles are drawn from numpy generators seeded with
+seed, so the output is reproducible for a given seed and input.
+The first val_count pairs of the shuffled output form the validation set:
+a uniform sample of exactly val_count pairs, which a split on a hash of the
+pairs would only give approximately. Since duplicates are removed before the
+split, a pair cannot be both in the training and in the validation set
+(unless deduplication is disabled).
+
+With a dedup key, pairs are instead assigned to buckets by the fingerprint
+of their key (salted with the seed), so that duplicates always land in the
+same bucket, in their original order: they are removed when the bucket is
+loaded (using up to dedup_memory_limit, see dedup.Deduplicator), without a
+separate deduplication pass over the corpus.
+'''
+
+MASK64 = (1 << 64) - 1
+DEDUP_BATCH_LINES = 100000
+
+def num_buckets(total_bytes, memory_limit):
+    # Lines are loaded as a list of bytes objects (~33 bytes of overhead per line)
+    # and joined again before writing, so allow for ~3x the size of a bucket
+    return max(1, -(-total_bytes * 3 // memory_limit))
+
+class BucketShuffle:
+    def __init__(self, buckets, seed=None, tmp_dir=None, dedup_key=None, dedup_bits=64, dedup_memory_limit=1024 * 1024 * 1024):
+        if dedup_key is not None and dedup_key not in DEDUP_KEYS:
+            raise ValueError(f"Invalid dedup key {dedup_key} (must be one of {', '.join(DEDUP_KEYS)})")
+        seeds = np.random.SeedSequence(seed).spawn(buckets + 1)
+        self.rng = np.random.default_rng(seeds[0])
+        self.salt = int(self.rng.integers(0, MASK64, dtype=np.uint64))
+        self.bucket_seeds = seeds[1:]
+        self.dedup_key = dedup_key
+        self.dedup_bits = dedup_bits
+        self.dedup_memory_limit = dedup_memory_limit
+        self.tmp_dir = tmp_dir
+        self.files = []
+        self.paths = []
+        for k in range(buckets):
+            fd, path = tempfile.mkstemp(prefix=f"shuffle-{k}-", suffix=".txt", dir=tmp_dir)
+            self.files.append(os.fdopen(fd, "wb"))
+            self.paths.append(path)
+
+    def _fingerprint(self, src, tgt):
+        return fingerprint(dedup_data(src.rstrip(b"\n"), tgt.rstrip(b"\n"), self.dedup_key), self.dedup_bits)
+
+    def add(self, src_lines, tgt_lines):
+        """Add pairs of newline terminated lines (bytes) to the buckets"""
+        k = len(self.files)
+        if self.dedup_key is None:
+            buckets = self.rng.integers(0, k, size=len(src_lines)).tolist()
+        else:
+            buckets = [((((self._fingerprint(src, tgt) & MASK64) ^ self.salt) * 0x9E3779B97F4A7C15 & MASK64) >> 32) % k
+                       for src, tgt in zip(src_lines, tgt_lines)]
+        out = [[] for f in self.files]
+        for k, src, tgt in zip(buckets, src_lines, tgt_lines):
+            out[k].append(src)
+            out[k].append(tgt)
+        for f, lines in zip(self.files, out):
+            if len(lines) > 0:
+                f.write(b"".join(lines))
+
+    def write(self, src_bytes, tgt_bytes):
+        """Add a batch of newline terminated source and target lines
+        (lines are stripped)"""
+        src_lines = [l.strip() + b"\n" for l in src_bytes.split(b"\n")[:-1]]
+        tgt_lines = [l.strip() + b"\n" for l in tgt_bytes.split(b"\n")[:-1]]
+        self.add(src_lines, tgt_lines)
+
+    def shuffled(self):
+        """Yields the (source lines, target lines, removed duplicates) of each bucket, shuffled"""
+        for f in self.files:
+            f.close()
+        for path, seed in zip(self.paths, self.bucket_seeds):
+            with open(path, "rb") as fp:
+                lines = fp.read().split(b"\n")
+            os.unlink(path)
+            src = lines[0:-1:2]
+            tgt = lines[1:-1:2]
+            del lines
+
+            keep = range(len(src))
+            if self.dedup_key is not None:
+                dedup = Deduplicator(self.dedup_bits, self.dedup_memory_limit, tmp_dir=self.tmp_dir)
+                for begin in range(0, len(src), DEDUP_BATCH_LINES):
+                    end = begin + DEDUP_BATCH_LINES
+                    dedup.add(begin, [self._fingerprint(line_s, line_t) for line_s, line_t in zip(src[begin:end], tgt[begin:end])])
+                duplicates = dedup.finish()
+                keep = [i for i in range(len(src)) if i not in duplicates]
+
+            perm = np.random.default_rng(seed).permutation(len(keep)).tolist()
+            yield [src[keep[i]] for i in perm], [tgt[keep[i]] for i in perm], len(src) - len(keep)
+
+    def split(self, src_train, tgt_train, src_val, tgt_val, val_count):
+        """Write the shuffled pairs, the first val_count of them to the validation
+        files and the rest to the training files.
+        Returns (train count, val count, removed duplicates)."""
+        written = 0
+        removed = 0
+        with open(src_train, "wb") as st_fp, open(tgt_train, "wb") as tt_fp, \
+             open(src_val, "wb") as sv_fp, open(tgt_val, "wb") as tv_fp:
+            for src, tgt, duplicates in self.shuffled():
+                removed += duplicates
+                n = max(0, min(val_count - written, len(src)))
+                if n > 0:
+                    sv_fp.write(b"\n".join(src[:n]) + b"\n")
+                    tv_fp.write(b"\n".join(tgt[:n]) + b"\n")
+                if len(src) > n:
+                    st_fp.write(b"\n".join(src[n:]) + b"\n")
+                    tt_fp.write(b"\n".join(tgt[n:]) + b"\n")
+                written += len(src)
+        return max(0, written - val_count), min(written, val_count), removed
+
+    def close(self):
+        """Remove the bucket files (when split wasn't called)"""
+        for f, path in zip(self.files, self.paths):
+            f.close()
+            if os.path.isfile(path):
+                os.unlink(path)
+
+def shuffle_split(source, target, src_train, tgt_train, src_val, tgt_val, val_count,
+                  seed=None, memory_limit=1024 * 1024 * 1024, batch_lines=100000, keep=None):
+    """Shuffle the pairs of source/target and split them into training and
+    validation files. With keep (a boolean array), only the selected pairs
+    are included. Returns (train count, val count)."""
+    total = os.path.getsize(source) + os.path.getsize(target)
+    shuffle = BucketShuffle(num_buckets(total, memory_limit), seed, tmp_dir=os.path.dirname(os.path.abspath(src_train)))
+    try:
+        with open(source, "rb") as src_fp, open(target, "rb") as tgt_fp:
+            src_lines = []
+            tgt_lines = []
+            for line_no, (line_s, line_t) in enumerate(zip(src_fp, tgt_fp)):
+                if keep is not None and not keep[line_no]:
+                    continue
+                src_lines.append(line_s if line_s.endswith(b"\n") else line_s + b"\n")
+                tgt_lines.append(line_t if line_t.endswith(b"\n") else line_t + b"\n")
+                if len(src_lines) >= batch_lines:
+                    shuffle.add(src_lines, tgt_lines)
+                    src_lines = []
+                    tgt_lines = []
+            shuffle.add(src_lines, tgt_lines)
+        return shuffle.split(src_train, tgt_train, src_val, tgt_val, val_count)[:2]
+    finally:
+        shuffle.close()
@@ -0,0 +1,143 @@
+import os
+import json
+import hashlib
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import lineindex
+
+'''
+Cache of the SentencePiece token ids of the training corpus.
+
+src-train.txt and tgt-train.txt are encoded once, in parallel, and the ids of
+each side are stored as one uint16 (or uint32, for large vocabularies) array,
+with a uint64 array of the offset at which the ids of each line begin (count + 1
+items, so that token lengths are their differences). Arrays are memory-mapped.
+Lines are encoded the way OpenNMT's sentencepiece transform does (tokens joined
+by single spaces), so that the cached pieces can replace it during training.
+The cache is rebuilt when the corpus files or the model change.
+'''
+
+SIDES = ("src", "tgt")
+CHUNK_SIZE = 16 * 1024 * 1024
+
+def _fingerprint(path):
+    st = os.stat(path)
+    return [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+
+def _model_hash(model_path):
+    with open(model_path, "rb") as f:
+        return hashlib.md5(f.read()).hexdigest()
+
+def meta(model_path, src_path, tgt_path):
+    return {'model': _model_hash(model_path), 'src': _fingerprint(src_path), 'tgt': _fingerprint(tgt_path)}
+
+_processor = None
+
+def _encode_chunk(model_path, path, begin, end, dtype):
+    global _processor
+    if _processor is None:
+        import sentencepiece as spm
+        _processor = spm.SentencePieceProcessor(model_file=model_path)
+    with open(path, "rb") as f:
+        f.seek(begin)
+        lines = f.read(end - begin).decode("utf-8").split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    ids = _processor.encode([" ".join(l.split()) for l in lines])
+    lengths = np.fromiter(map(len, ids), dtype=np.uint64, count=len(ids))
+    flat = np.fromiter((i for line in ids for i in line), dtype=dtype, count=int(lengths.sum()))
+    return flat, lengths
+
+def _chunks(index, chunk_size):
+    """Byte ranges of about chunk_size bytes, snapped to line boundaries"""
+    begin = 0
+    while begin < index.size:
+        nxt = index.next_line(begin + chunk_size - 1)
+        end = index.size if nxt is None else nxt[1]
+        yield begin, end
+        begin = end
+
+def encode_file(model_path, path, out_dir, side, dtype, workers=None, chunk_size=CHUNK_SIZE):
+    """Write the ids and offsets of the lines of a file. Returns the number of lines."""
+    if workers is None:
+        workers = os.cpu_count() or 1
+    index = lineindex.load(path)
+    count = 0
+    total = 0
+    with open(os.path.join(out_dir, f"{side}.ids"), "wb") as ids_fp, \
+         open(os.path.join(out_dir, f"{side}.offsets"), "wb") as off_fp:
+        def write(flat, lengths):
+            nonlocal count, total
+            off_fp.write((np.cumsum(lengths) - lengths + np.uint64(total)).tobytes())
+            ids_fp.write(flat.tobytes())
+            count += len(lengths)
+            total += int(lengths.sum())
+
+        tasks = _chunks(index, chunk_size)
+        if workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+                # Keep a bounded number of chunks in flight, in order
+                pending = deque()
+                for begin, end in tasks:
+                    pending.append(executor.submit(_encode_chunk, model_path, path, begin, end, dtype))
+                    if len(pending) >= workers * 2:
+                        write(*pending.popleft().result())
+                while len(pending) > 0:
+                    write(*pending.popleft().result())
+        else:
+            for begin, end in tasks:
+                write(*_encode_chunk(model_path, path, begin, end, dtype))
+        off_fp.write(np.uint64(total).tobytes())
+    return count
+
+def update(cache_dir, model_path, src_path, tgt_path, workers=None):
+    """Build the cache of src_path/tgt_path, unless it's up to date"""
+    expected = meta(model_path, src_path, tgt_path)
+    meta_path = os.path.join(cache_dir, "meta.json")
+    if os.path.isfile(meta_path):
+        with open(meta_path, "r", encoding="utf-8") as f:
+            current = json.loads(f.read())
+        if {k: current.get(k) for k in expected} == expected:
+            return
+
+    import sentencepiece as spm
+    vocab_size = spm.SentencePieceProcessor(model_file=model_path).get_piece_size()
+    dtype = np.uint16 if vocab_size <= 1 << 16 else np.uint32
+
+    print(f"Encoding {src_path} and {tgt_path} with {model_path}")
+    os.makedirs(cache_dir, exist_ok=True)
+    if os.path.isfile(meta_path):
+        os.unlink(meta_path)
+    counts = [encode_file(model_path, path, cache_dir, side, dtype, workers) for side, path in zip(SIDES, (src_path, tgt_path))]
+    with open(meta_path, "w", encoding="utf-8") as f:
+        f.write(json.dumps({**expected, 'count': min(counts), 'dtype': np.dtype(dtype).name}))
+    print(f"Wrote {cache_dir} ({min(counts)} lines)")
+
+class SPCache:
+    def __init__(self, cache_dir):
+        with open(os.path.join(cache_dir, "meta.json"), "r", encoding="utf-8") as f:
+            m = json.loads(f.read())
+        self.count = m['count']
+        self.offsets = []
+        self.ids = []
+        for side in SIDES:
+            offsets = np.memmap(os.path.join(cache_dir, f"{side}.offsets"), dtype=np.uint64, mode="r")
+            self.offsets.append(offsets)
+            ids_path = os.path.join(cache_dir, f"{side}.ids")
+            self.ids.append(np.memmap(ids_path, dtype=m['dtype'], mode="r") if os.path.getsize(ids_path) > 0 else np.zeros(0, dtype=m['dtype']))
+
+    def __len__(self):
+        return self.count
+
+    def length(self, line, side=0):
+        """Number of tokens of a (0-based) line"""
+        return int(self.offsets[side][line + 1] - self.offsets[side][line])
+
+    def lengths(self, side=0):
+        return np.diff(self.offsets[side])
+
+    def line_ids(self, line, side=0):
+        """Token ids of a (0-based) line"""
+        return self.ids[side][int(self.offsets[side][line]):int(self.offsets[side][line + 1])].tolist()
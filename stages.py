@@ -0,0 +1,147 @@
+import os
+import json
+import hashlib
+from lineindex import INDEX_EXT
+
+'''
+Stages of the training pipeline (fetch, merge, spm, vocab, train, average,
+convert, package; see train.py).
+
+Each stage declares the stages it depends on, its input files and the config
+values it uses (params), and its outputs. When a stage completes, the state
+file records its params, a content hash of its inputs and outputs, and the
+output hashes of its dependencies. A stage runs again only when one of those
+changed, or when its outputs are missing or were modified. A stage that runs
+again without changing the content of its outputs doesn't make the stages that
+depend on it run again.
+
+With dry_run, stages never run: the reasons why they would are printed instead.
+'''
+
+STATE_FILE = "stages.json"
+FULL_HASH_SIZE = 64 * 1024 * 1024
+SAMPLE_SIZE = 64 * 1024
+SAMPLES = 32
+
+def hash_file(path):
+    """Content hash of a file. Files larger than FULL_HASH_SIZE are hashed by
+    their size and SAMPLES blocks evenly spaced between their head and tail."""
+    md5 = hashlib.md5()
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        if size <= FULL_HASH_SIZE:
+            for chunk in iter(lambda: f.read(16 * 1024 * 1024), b""):
+                md5.update(chunk)
+        else:
+            md5.update(str(size).encode("utf-8"))
+            for i in range(SAMPLES):
+                f.seek((size - SAMPLE_SIZE) * i // (SAMPLES - 1))
+                md5.update(f.read(SAMPLE_SIZE))
+    return md5.hexdigest()
+
+def hash_path(path):
+    """Content hash of a file or directory (None if it doesn't exist).
+    Line indexes (see lineindex.py) are left out of directory hashes."""
+    if os.path.isfile(path):
+        return hash_file(path)
+    if os.path.isdir(path):
+        md5 = hashlib.md5()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                if name.endswith(INDEX_EXT):
+                    continue
+                p = os.path.join(root, name)
+                md5.update(os.path.relpath(p, path).encode("utf-8"))
+                md5.update(hash_file(p).encode("utf-8"))
+        return md5.hexdigest()
+    return None
+
+def _changed_keys(old, new, prefix=""):
+    """Dotted keys whose values differ between two dicts (nested dicts are compared key by key)"""
+    changed = []
+    for k in sorted(set(old) | set(new), key=str):
+        a, b = old.get(k), new.get(k)
+        if isinstance(a, dict) and isinstance(b, dict):
+            changed += _changed_keys(a, b, f"{prefix}{k}.")
+        elif a != b:
+            changed.append(f"{prefix}{k}")
+    return changed
+
+class Stages:
+    def __init__(self, state_path, dry_run=False, reset=False):
+        self.state_path = state_path
+        self.dry_run = dry_run
+        self.state = {}
+        if not reset and os.path.isfile(state_path):
+            with open(state_path, "r", encoding="utf-8") as f:
+                self.state = json.loads(f.read())
+        self.pending = {}
+        self.planned = []
+
+    def check(self, name, deps=[], inputs=[], params={}, outputs=[], force=False):
+        """Reasons why a stage must run (empty if it's up to date)"""
+        params = json.loads(json.dumps(params))
+        current = {
+            'params': params,
+            'inputs': {p: hash_path(p) for p in inputs},
+            'deps': {d: self.state.get(d, {}).get('outputs') for d in deps},
+            'outputs': outputs,
+        }
+        self.pending[name] = current
+
+        reasons = []
+        if force:
+            reasons.append("forced")
+        previous = self.state.get(name)
+        if previous is None:
+            return reasons + ["no previous run"]
+
+        changed = _changed_keys(previous['params'], params)
+        if len(changed) > 0:
+            reasons.append(f"config changed: {', '.join(changed)}")
+        for d in deps:
+            if d in self.planned:
+                reasons.append(f"{d} would run")
+            elif previous['deps'].get(d) != current['deps'][d]:
+                reasons.append(f"outputs of {d} changed")
+        for p in _changed_keys(previous['inputs'], current['inputs']):
+            reasons.append(f"input {'missing' if current['inputs'].get(p) is None else 'changed'}: {p}")
+        for p in outputs:
+            h = hash_path(p)
+            if h is None:
+                reasons.append(f"output missing: {p}")
+            elif h != previous['outputs'].get(p):
+                reasons.append(f"output modified: {p}")
+        return reasons
+
+    def stale(self, name):
+        """Whether the params, inputs or dependencies of a checked stage changed
+        since it last completed (rather than only its outputs). A stage that never
+        completed (e.g. it was interrupted) isn't stale: its outputs can be resumed."""
+        previous = self.state.get(name)
+        current = self.pending[name]
+        return previous is not None and any(previous[k] != current[k] for k in ['params', 'inputs', 'deps'])
+
+    def run(self, name, deps=[], inputs=[], params={}, outputs=[], force=False):
+        """Check a stage and print why it runs. Returns True if it must run
+        (never with dry_run); call done once it completed."""
+        reasons = self.check(name, deps, inputs, params, outputs, force)
+        if len(reasons) == 0:
+            print(f"[{name}] up to date")
+            return False
+        if self.dry_run:
+            print(f"[{name}] would run: {'; '.join(reasons)}")
+            self.planned.append(name)
+            return False
+        print(f"[{name}] running: {'; '.join(reasons)}")
+        return True
+
+    def done(self, name, outputs=None):
+        """Record the completion of a stage, with the outputs it was checked with
+        (or outputs, when they are only known once it ran)"""
+        current = self.pending.pop(name)
+        current['outputs'] = {p: hash_path(p) for p in (outputs if outputs is not None else current['outputs'])}
+        self.state[name] = current
+        with open(self.state_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(self.state, indent=4))
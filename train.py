@@ -10,13 +10,17 @@ import yaml
 import subprocess
 import re
 import zipfile
-import ctranslate2
 from opus import get_opus_dataset_url
 from net import download
-from data import sources_changed, merge_shuffle, extract_flores_val
+from data import merge_shuffle, extract_flores_val, code_hash, SHARD_SIZE
+import archive
 import sentencepiece as spm
-from onmt_tools import average_models, sp_vocab_to_onmt_vocab
+from onmt_tools import average_models, sp_vocab_to_onmt_vocab, transform_names
 from sbd import package_sbd
+import spcache
+import devices
+from sampling import stratified_sample
+from stages import Stages, STATE_FILE
 
 parser = argparse.ArgumentParser(description='Train LibreTranslate compatible models')
 parser.add_argument('--config',
@@ -44,6 +48,9 @@ parser.add_argument('--inflight',
 parser.add_argument('--byte_fallback_off',
     action='store_false',
     help='Disable byte fallback during SentencePiece training. Default is enabled (True).')
+parser.add_argument('--dry-run',
+    action='store_true',
+    help='Explain which stages would run and why, without running them. Default: %(default)s')
 
 
 
@@ -82,10 +89,26 @@ rel_onmt_dir = f"{rel_run_dir}/opennmt"
 os.makedirs(cache_dir, exist_ok=True)
 os.makedirs(utils_dir, exist_ok=True)
 
-if args.rerun and os.path.isdir(run_dir):
+if args.rerun and os.path.isdir(run_dir) and not args.dry_run:
     shutil.rmtree(run_dir)
 os.makedirs(run_dir, exist_ok=True)
 
+# Only the stages whose inputs changed run again (see stages.py)
+stages = Stages(os.path.join(run_dir, STATE_FILE), dry_run=args.dry_run, reset=args.rerun)
+
+def cache_path(s):
+    return os.path.join(cache_dir, hashlib.md5(s.encode('utf-8')).hexdigest())
+
+remote_sources = []
+for s in config['sources']:
+    s = s["source"] if isinstance(s, dict) else s
+    if not s.lower().startswith("file://"):
+        remote_sources.append(s)
+def fetch_outputs():
+    # Downloaded archives are extracted to a directory (or kept as a .zip)
+    return [p if os.path.isdir(p) else p + ".zip" for p in map(cache_path, remote_sources)]
+fetch = stages.run("fetch", params={'sources': remote_sources}, outputs=fetch_outputs())
+
 sources = {}
 
 for s in config['sources']:
@@ -104,11 +127,12 @@ for s in config['sources']:
         s = s["source"]
 
     md5 = hashlib.md5(s.encode('utf-8')).hexdigest()
+    local = s.lower().startswith("file://")
     
     def add_source_from(dir):
         source, target = None, None
         skip_reverse = False
-        for f in [f.path for f in os.scandir(dir) if f.is_file()]:
+        for f in archive.list_files(dir):
             if "target" in f.lower():
                 target = f
             elif f.lower().endswith(f".{config['to']['code']}"):
@@ -135,6 +159,7 @@ for s in config['sources']:
                 'transforms': transforms,
                 'augmenters': augmenters,
                 'weight': weight,
+                'local': local,
             }
         else:
             print(f"Cannot find a source.txt and a target.txt in {s} ({dir}). Exiting...")
@@ -143,6 +168,13 @@ for s in config['sources']:
     if s.lower().startswith("file://"):
         add_source_from(s[7:])
     else:
+        # Network/OPUS URL
+        dataset_path = cache_path(s)
+        zip_path = dataset_path + ".zip"
+        if args.dry_run and not (os.path.isdir(dataset_path) or os.path.isfile(zip_path)):
+            print(f"Would download {s}")
+            continue
+
         if s.lower().startswith("opus://"):
             try:
                 s = get_opus_dataset_url(s[7:], config["from"]["code"], config["to"]["code"], run_dir)
@@ -150,12 +182,8 @@ for s in config['sources']:
                 print(e)
                 exit(1)
 
-        # Network/OPUS URL
-        dataset_path = os.path.join(cache_dir, md5)
-        zip_path = dataset_path + ".zip"
-
         # Download first?
-        if not os.path.isdir(dataset_path):
+        if not os.path.isdir(dataset_path) and not args.dry_run:
             def download_source():
                 def print_progress(progress):
                     print(f"\r{s} [{int(progress)}%]     ", end='\r')
@@ -175,22 +203,30 @@ for s in config['sources']:
                     os.unlink(zip_path)
                     download_source()
 
-            os.makedirs(dataset_path, exist_ok=True)
-            print(f"Extracting {zip_path} to {dataset_path}")
-            with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-                zip_ref.extractall(dataset_path)
-            
-            os.unlink(zip_path)
-        
-            subfolders = [ f.path for f in os.scandir(dataset_path) if f.is_dir()]
-            if len(subfolders) == 1:
-                # Move files from subfolder
-                for f in [f.path for f in os.scandir(subfolders[0]) if f.is_file()]:
-                    shutil.move(f, dataset_path)
-                
-                shutil.rmtree(subfolders[0])
+            # Sources are read directly from the downloaded archive, unless they must
+            # be extracted (weighted sources are read by OpenNMT/SentencePiece), or they are
+            # large enough to be split into shards (which archive members cannot be)
+            if weight is not None:
+                extract = True
+            elif config.get('extract_sources') is not None:
+                extract = config['extract_sources']
+            else:
+                extract = max([archive.size(f) for f in archive.list_files(zip_path)], default=0) > SHARD_SIZE
+
+            if extract:
+                print(f"Extracting {zip_path} to {dataset_path}")
+                archive.extract(zip_path, dataset_path)
+                os.unlink(zip_path)
         
-        add_source_from(dataset_path)
+        add_source_from(dataset_path if os.path.isdir(dataset_path) else zip_path)
+
+if fetch:
+    # Whether archives are extracted is only known once they are downloaded
+    stages.done("fetch", outputs=fetch_outputs())
+
+# With onthefly_augmenters, the augmenters of the config are applied during
+# training (see onmt_tools.py) and the merged corpus is stored unaugmented
+onthefly_augmenters = config.get('augmenters', []) if config.get('onthefly_augmenters', False) else []
 
 for k in sources:
     if config.get('filters'):
@@ -199,36 +235,75 @@ for k in sources:
     if config.get('transforms'):
         for t in reversed(config['transforms']):
             sources[k]['transforms'].insert(0, t)
-    if config.get('augmenters'):
+    if config.get('augmenters') and len(onthefly_augmenters) == 0:
         for a in reversed(config['augmenters']):
             sources[k]['augmenters'].insert(0, a)
 
     print(f" - {k} (hash:{sources[k]['hash'][:7]})")
 
-packaged_sbd = package_sbd(run_dir, config['from']['code'])
-
 all_weighted = sum([1 for k in sources if sources[k]['weight'] is not None]) == len(sources)
-if all_weighted:
-    extract_flores_val(config['from']['code'], config['to']['code'], run_dir, dataset="devtest")
-changed = merge_shuffle(sources, run_dir)
-has_merged = os.path.isfile(os.path.join(rel_run_dir, 'src-train.txt'))
+weighted_files = [archive.container(sources[k][side]) for k in sources for side in ['source', 'target'] if sources[k]['weight'] is not None]
+local_files = [archive.container(sources[k][side]) for k in sources for side in ['source', 'target'] if sources[k]['local'] and sources[k]['weight'] is None]
+
+merge_outputs = [os.path.join(run_dir, f) for f in ["src-val.txt", "tgt-val.txt"]]
+if not all_weighted:
+    merge_outputs += [os.path.join(run_dir, f) for f in ["src-train.txt", "tgt-train.txt"]]
+merge_params = {
+    'sources': {k: {key: sources[k][key] for key in ['from', 'to', 'filters', 'transforms', 'augmenters', 'weight']} for k in sources},
+    'code': code_hash(),
+    'dedup_key': config.get('dedup_key', 'pair'),
+    'remove_near_duplicates': config.get('remove_near_duplicates', False),
+    'shuffle_seed': config.get('shuffle_seed'),
+}
+if stages.run("merge", deps=["fetch"], inputs=local_files, params=merge_params, outputs=merge_outputs):
+    if all_weighted:
+        extract_flores_val(config['from']['code'], config['to']['code'], run_dir, dataset="devtest")
+    merge_shuffle(sources, run_dir,
+                  workers=config.get('merge_workers'),
+                  use_processes=config.get('merge_processes', True),
+                  dedup_key=config.get('dedup_key', 'pair'),
+                  dedup_memory_limit=config.get('dedup_memory_mb', 1024) * 1024 * 1024,
+                  remove_near_duplicates=config.get('remove_near_duplicates', False),
+                  adaptive_filters=config.get('adaptive_filters', False),
+                  shuffle_seed=config.get('shuffle_seed'),
+                  shuffle_memory_limit=config.get('shuffle_memory_mb', 1024) * 1024 * 1024,
+                  force=True)
+    stages.done("merge")
+has_merged = os.path.isfile(os.path.join(rel_run_dir, 'src-train.txt')) or (args.dry_run and not all_weighted)
 
 sp_model_path = os.path.join(run_dir, "sentencepiece.model")
-if not os.path.isfile(sp_model_path) or changed:
+sp_vocab_file = os.path.join(run_dir, "sentencepiece.vocab")
+spm_params = {
+    'vocab_size': config.get('vocab_size', 50000),
+    'character_coverage': config.get('character_coverage', 0.9999),
+    'input_sentence_size': config.get('input_sentence_size', 2000000),
+    'shuffle_seed': config.get('shuffle_seed'),
+    'byte_fallback': args.byte_fallback_off,
+    # Weighted sources are sampled in proportion to their weight
+    'weights': {k: sources[k]['weight'] for k in sources if sources[k]['weight'] is not None},
+}
+if stages.run("spm", deps=["merge"], inputs=weighted_files, params=spm_params, outputs=[sp_model_path, sp_vocab_file]):
+    # Sample the input sentences once (each side of each source in proportion
+    # to its weight, the merged corpus having a weight of 1), and reuse the
+    # sample if the vocabulary size has to be reduced
+    datasets = []
+    if has_merged:
+        datasets += [(os.path.join(run_dir, "src-train.txt"), 1), (os.path.join(run_dir, "tgt-train.txt"), 1)]
+    for k in sources:
+        if sources[k]['weight'] is not None:
+            datasets += [(sources[k]['source'], sources[k]['weight']), (sources[k]['target'], sources[k]['weight'])]
+    sp_sample_path = os.path.join(run_dir, "sentencepiece-sample.txt")
+    input_sentence_size = config.get('input_sentence_size', 2000000)
+    print(f"Sampling {input_sentence_size} sentences for SentencePiece")
+    sample_size = stratified_sample(datasets, input_sentence_size, sp_sample_path, seed=config.get('shuffle_seed'))
+
     while True:
         try:
-            datasets = []
-            if has_merged:
-                datasets += [os.path.join(run_dir, "src-train.txt"), os.path.join(run_dir, "tgt-train.txt")]
-            for k in sources:
-                if sources[k]['weight'] is not None:
-                    datasets += [sources[k]['source'], sources[k]['target']]
             #Byte-fallback (train byte tokens with character_coverage 0.9999, 0.9995 for CJK
-            # doubling sentence input makes for more accurate sampling
-            spm.SentencePieceTrainer.train(input=datasets, 
+            spm.SentencePieceTrainer.train(input=sp_sample_path, 
                                             model_prefix=f"{run_dir}/sentencepiece", vocab_size=config.get('vocab_size', 50000),
                                             character_coverage=config.get('character_coverage', 0.9999),
-                                            input_sentence_size=config.get('input_sentence_size', 2000000),
+                                            input_sentence_size=sample_size,
                                             shuffle_input_sentence=True,
                                             byte_fallback=args.byte_fallback_off)
             break
@@ -246,7 +321,9 @@ if not os.path.isfile(sp_model_path) or changed:
                 print(err)
                 exit(1)
 
-os.makedirs(onmt_dir, exist_ok=True)
+    os.unlink(sp_sample_path)
+    stages.done("spm")
+
 # different transforms at train & valid because of tokenization bug in onmt3.5
 # RoPE+gated-activation requires upgrading, further details on architecture at upcoming TRANSFORMERS.md
 train_transforms = ['sentencepiece', 'filtertoolong']
@@ -267,6 +344,14 @@ if has_merged:
         'weight': 1
     }
 
+# Filters and transforms of weighted sources, and augmenters, can run on the fly,
+# in the dataloader workers of onmt_train (see onmt_tools.py)
+onthefly_spec = {}
+if has_merged and len(onthefly_augmenters) > 0:
+    onthefly_spec['corpus_1'] = {'from': config['from']['code'], 'to': config['to']['code'],
+                                 'filters': [], 'transforms': [], 'augmenters': onthefly_augmenters}
+    corpora['corpus_1']['transforms'] = transform_names(onthefly_spec['corpus_1']) + train_transforms
+
 for k in sources:
     if sources[k]['weight'] is not None:
         corpora[k] = {
@@ -275,6 +360,19 @@ for k in sources:
             'weight': sources[k]['weight'],
             'transforms': train_transforms,
         }
+        if config.get('onthefly_filters', False):
+            spec = {key: sources[k][key] for key in ['from', 'to', 'filters', 'transforms']}
+            spec['augmenters'] = onthefly_augmenters + sources[k]['augmenters'] if len(onthefly_augmenters) > 0 else []
+            names = transform_names(spec)
+            if len(names) > 0:
+                corpora[k]['transforms'] = names + train_transforms
+                onthefly_spec[k] = spec
+
+# The merged training corpus can be encoded once with the SentencePiece model,
+# so that onmt_train reads token ids instead of re-encoding every line (see spcache.py)
+sp_cache = config.get('sp_cache', False) and has_merged and corpora['corpus_1']['transforms'] == train_transforms
+if sp_cache:
+    corpora['corpus_1']['transforms'] = ['locomotive_sp_cache']
 
 onmt_config = {
     'save_data': rel_onmt_dir,
@@ -352,11 +450,6 @@ onmt_config = {
     'seed': -1, #onmt_default (auto seed) -when researching : any positive value-
 }
 
-no_gpu = ctranslate2.get_cuda_device_count() == 0
-if sys.platform == 'darwin' or no_gpu:
-    # CPU
-    del onmt_config['gpu_ranks']
-
 if args.toy:
     toy_config = {
         'valid_steps': 100, 
@@ -371,29 +464,99 @@ for k in onmt_config:
     if k in config:
         onmt_config[k] = config[k]
 
-onmt_config_path = os.path.join(run_dir, "config.yml")
-with open(onmt_config_path, "w", encoding="utf-8") as f:
-    f.write(yaml.dump(onmt_config))
-    print(f"Wrote {onmt_config_path}")
+# Use all the GPUs (or CPUs) of the machine, keeping the effective batch
+train_env = devices.configure(onmt_config, config)
+
+if len(onthefly_spec) > 0:
+    onmt_config['locomotive_spec'] = f'{rel_run_dir}/onthefly.json'
+if sp_cache:
+    onmt_config['locomotive_sp_cache'] = f'{rel_run_dir}/spcache'
 
-sp_vocab_file = os.path.join(run_dir, "sentencepiece.vocab")
 onmt_vocab_file = os.path.join(onmt_dir, "openmt.vocab")
-if changed and os.path.isfile(onmt_vocab_file):
-    os.unlink(onmt_vocab_file)
-    
-if not os.path.isfile(onmt_vocab_file):
+if stages.run("vocab", deps=["spm"], outputs=[onmt_vocab_file]):
+    os.makedirs(onmt_dir, exist_ok=True)
     #subprocess.run(["onmt_build_vocab", "-config", onmt_config_path, "-n_sample", "-1", "-num_threads", str(os.cpu_count())])
     sp_vocab_to_onmt_vocab(sp_vocab_file, onmt_vocab_file)
+    stages.done("vocab")
 
 last_checkpoint = os.path.join(onmt_dir, os.path.basename(onmt_config["save_model"]) + f'_step_{onmt_config["train_steps"]}.pt')
 def get_checkpoints():
     chkpts = [cp for cp in glob.glob(os.path.join(onmt_dir, "*.pt")) if "averaged.pt" not in cp]
     return list(sorted(chkpts, key=lambda x: int(re.findall('\d+', x)[0])))
 
-if (not (os.path.isfile(last_checkpoint) or args.inflight)) or changed or args.rerun_onmt:
+# Options that don't affect the checkpoints: changing them resumes training
+# instead of restarting it
+RESUMABLE_OPTIONS = ['train_steps', 'save_checkpoint_steps', 'keep_checkpoint', 'valid_steps', 'early_stopping',
+                     'num_worker', 'world_size', 'gpu_ranks', 'queue_size', 'valid_batch_size', 'valid_metrics',
+                     'batch_size', 'accum_count']
+train_params = {k: onmt_config[k] for k in onmt_config if k not in RESUMABLE_OPTIONS}
+# The split of the batch between devices doesn't matter
+accum_count = onmt_config['accum_count']
+if isinstance(accum_count, int):
+    train_params['effective_batch'] = onmt_config['batch_size'] * accum_count * onmt_config['world_size']
+else:
+    train_params['effective_batch'] = [onmt_config['batch_size'], accum_count, onmt_config['world_size']]
+train_params['onthefly_spec'] = onthefly_spec
+
+# The largest batch_size that fits in the memory of a device is probed before
+# training (see probe.py), and batch_size/accum_count are set to keep the effective batch
+probe_path = os.path.join(run_dir, "probe.json")
+if config.get('probe_batch_size', True) and isinstance(accum_count, int) and not args.inflight:
+    probe_params = {
+        **train_params,
+        'devices': onmt_config.get('gpu_ranks', []),
+        'headroom': config.get('probe_headroom', 0.1),
+        'memory_mb': config.get('probe_memory_mb'),
+    }
+    if stages.run("probe", deps=["vocab"], params=probe_params, outputs=[probe_path]):
+        if os.path.isfile(probe_path):
+            os.unlink(probe_path)
+        probe_config_path = os.path.join(run_dir, "probe.yml")
+        with open(probe_config_path, "w", encoding="utf-8") as f:
+            f.write(yaml.dump(onmt_config))
+        cmd = [sys.executable, os.path.join(current_dir, "probe.py"), "--config", probe_config_path, "--output", probe_path,
+               "--max-batch-size", str(onmt_config['batch_size'] * accum_count), "--headroom", str(probe_params['headroom'])]
+        if probe_params['memory_mb'] is not None:
+            cmd += ["--memory-mb", str(probe_params['memory_mb'])]
+        if subprocess.run(cmd, env={**os.environ, **train_env}).returncode == 0:
+            stages.done("probe")
+        else:
+            print("WARNING: the batch size probe failed, using the configured batch_size")
+        os.unlink(probe_config_path)
+
+    if os.path.isfile(probe_path) and not args.dry_run:
+        with open(probe_path, "r", encoding="utf-8") as f:
+            max_batch_size = json.loads(f.read())['batch_size']
+        if max_batch_size > 0:
+            onmt_config['batch_size'], onmt_config['accum_count'] = devices.fit_batch(onmt_config['batch_size'], accum_count, max_batch_size)
+            print(f"Probed batch_size {max_batch_size}: training with batch_size {onmt_config['batch_size']}, accum_count {onmt_config['accum_count']}")
+        else:
+            print("WARNING: not even the smallest batch fits in memory, using the configured batch_size")
+
+if not args.inflight and stages.run("train", deps=["merge", "spm", "vocab"], inputs=weighted_files, params=train_params,
+                                    outputs=[last_checkpoint], force=args.rerun_onmt):
+    restart = args.rerun_onmt or stages.stale("train")
+
+    if sp_cache:
+        spcache.update(os.path.join(run_dir, "spcache"), sp_model_path,
+                       os.path.join(run_dir, "src-train.txt"), os.path.join(run_dir, "tgt-train.txt"))
+
+    onthefly_spec_path = os.path.join(run_dir, "onthefly.json")
+    if len(onthefly_spec) > 0:
+        with open(onthefly_spec_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(onthefly_spec, indent=4))
+
+    onmt_config_path = os.path.join(run_dir, "config.yml")
+    with open(onmt_config_path, "w", encoding="utf-8") as f:
+        f.write(yaml.dump(onmt_config))
+        print(f"Wrote {onmt_config_path}")
+
     cmd = ["onmt_train", "-config", onmt_config_path]
+    if len(onthefly_spec) > 0 or sp_cache:
+        # onmt_train, with the Locomotive transforms registered
+        cmd = [sys.executable, os.path.join(current_dir, "onmt_tools.py"), "-config", onmt_config_path]
 
-    if args.rerun_onmt:
+    if restart:
         delete_checkpoints = glob.glob(os.path.join(onmt_dir, "*.pt"))
         for dc in delete_checkpoints:
             os.unlink(dc)
@@ -421,81 +584,96 @@ if (not (os.path.isfile(last_checkpoint) or args.inflight)) or changed or args.r
     
     # Resume?
     checkpoints = get_checkpoints()
-    if len(checkpoints) > 0 and not changed:
+    if len(checkpoints) > 0:
         print(f"Resuming from {checkpoints[-1]}")
         cmd += ["--train_from", checkpoints[-1]]
 
-    subprocess.run(cmd)
+    if subprocess.run(cmd, env={**os.environ, **train_env}).returncode == 0:
+        stages.done("train")
 
 # Average
 average_checkpoint = os.path.join(run_dir, "averaged.pt")
 checkpoints = get_checkpoints()
 print(f"Total checkpoints: {len(checkpoints)}")
 
-if len(checkpoints) == 0:
+if len(checkpoints) == 0 and not args.dry_run:
     print("Something went wrong, looks like onmt_train failed?")
     exit(1)
 
-if os.path.isfile(average_checkpoint):
-    os.unlink(average_checkpoint)
-
+avg_num = min(config.get('avg_checkpoints', 1), len(checkpoints))
 if len(checkpoints) == 1 or args.inflight:
     print("Single checkpoint")
+    avg_num = 1
+elif avg_num == 1:
+    print("No need to average 1 model")
+if avg_num <= 1 and len(checkpoints) > 0:
     average_checkpoint = checkpoints[-1]
-else:
-    if config.get('avg_checkpoints', 1) == 1:
-        print("No need to average 1 model")
-        average_checkpoint = checkpoints[-1]
-    else:
-        avg_num = min(config.get('avg_checkpoints', 1), len(checkpoints))
+
+if stages.run("average", deps=["train"], inputs=checkpoints[-avg_num:], params={'avg_checkpoints': avg_num},
+              outputs=[average_checkpoint] if avg_num > 1 else []):
+    if os.path.isfile(os.path.join(run_dir, "averaged.pt")):
+        os.unlink(os.path.join(run_dir, "averaged.pt"))
+    if avg_num > 1:
         print(f"Averaging {avg_num} models")
         average_models(checkpoints[-avg_num:], average_checkpoint)
+    stages.done("average")
+
 # Quantize
 ct2_model_dir = os.path.join(run_dir, "model")
-if os.path.isdir(ct2_model_dir):
-    shutil.rmtree(ct2_model_dir)
-
-print("Converting to ctranslate2")
-subprocess.run([
-        "ct2-opennmt-py-converter",
-        "--model_path",
-        average_checkpoint,
-        "--output_dir",
-        ct2_model_dir,
-        "--quantization",
-        "int8"])
+if stages.run("convert", deps=["average"], inputs=[average_checkpoint], params={'quantization': 'int8'}, outputs=[ct2_model_dir]):
+    if os.path.isdir(ct2_model_dir):
+        shutil.rmtree(ct2_model_dir)
+
+    print("Converting to ctranslate2")
+    subprocess.run([
+            "ct2-opennmt-py-converter",
+            "--model_path",
+            average_checkpoint,
+            "--output_dir",
+            ct2_model_dir,
+            "--quantization",
+            "int8"])
+    stages.done("convert")
 
 # Create .argosmodel package
 package_slug = f"translate-{config['from']['code']}_{config['to']['code']}-{config['version'].replace('.', '_')}"
 package_file = os.path.join(run_dir, f"{package_slug}.argosmodel")
-if os.path.isfile(package_file):
-    os.unlink(package_file)
-package_folder = os.path.join(run_dir, package_slug)
-if os.path.isdir(package_folder):
-    shutil.rmtree(package_folder)
-os.makedirs(package_folder, exist_ok=True)
-
-readme_file = os.path.join(package_folder, "README.md")
-with open(readme_file, "w", encoding="utf-8") as f:
-    f.write(readme)
-metadata_file = os.path.join(package_folder, "metadata.json")
-with open(metadata_file, "w", encoding="utf-8") as f:
-    f.write(json.dumps(metadata))
-
-shutil.copy(sp_model_path, package_folder)
-shutil.copytree(ct2_model_dir, os.path.join(package_folder, "model"))
-if os.path.isdir(packaged_sbd):
-    shutil.copytree(packaged_sbd, os.path.join(package_folder, os.path.basename(packaged_sbd)))
-
-print(f"Writing {package_file}")
-zip_filename = os.path.join(run_dir, f"{package_slug}.zip")
-def zipdir(path, ziph):
-    for root, dirs, files in os.walk(path):
-        for file in files:
-            ziph.write(os.path.join(root, file),
-                       os.path.relpath(os.path.join(root, file),
-                                       os.path.join(path, '..')))
-with zipfile.ZipFile(zip_filename, 'w') as zipf:
-    zipdir(package_folder, zipf)
-os.rename(zip_filename, package_file)
-print("Done!")
+if stages.run("package", deps=["spm", "convert"], params={'metadata': metadata, 'readme': readme}, outputs=[package_file]):
+    packaged_sbd = package_sbd(run_dir, config['from']['code'])
+
+    if os.path.isfile(package_file):
+        os.unlink(package_file)
+    package_folder = os.path.join(run_dir, package_slug)
+    if os.path.isdir(package_folder):
+        shutil.rmtree(package_folder)
+    os.makedirs(package_folder, exist_ok=True)
+
+    readme_file = os.path.join(package_folder, "README.md")
+    with open(readme_file, "w", encoding="utf-8") as f:
+        f.write(readme)
+    metadata_file = os.path.join(package_folder, "metadata.json")
+    with open(metadata_file, "w", encoding="utf-8") as f:
+        f.write(json.dumps(metadata))
+
+    shutil.copy(sp_model_path, package_folder)
+    shutil.copytree(ct2_model_dir, os.path.join(package_folder, "model"))
+    if os.path.isdir(packaged_sbd):
+        shutil.copytree(packaged_sbd, os.path.join(package_folder, os.path.basename(packaged_sbd)))
+
+    print(f"Writing {package_file}")
+    zip_filename = os.path.join(run_dir, f"{package_slug}.zip")
+    def zipdir(path, ziph):
+        for root, dirs, files in os.walk(path):
+            for file in files:
+                ziph.write(os.path.join(root, file),
+                           os.path.relpath(os.path.join(root, file),
+                                           os.path.join(path, '..')))
+    with zipfile.ZipFile(zip_filename, 'w') as zipf:
+        zipdir(package_folder, zipf)
+    os.rename(zip_filename, package_file)
+    stages.done("package")
+
+if args.dry_run:
+    print(f"Dry run: {len(stages.planned)} stage(s) would run")
+else:
+    print("Done!")
@@ -0,0 +1,169 @@
+import os
+import json
+import shutil
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import lineindex
+
+'''
+Persistent trigram index of text files, used by find.py.
+
+A file is split into segments of about segment_size bytes, and segments into
+blocks of about block_size bytes (both snapped to line boundaries). For each
+segment, the index maps every trigram of the lowercased UTF-8 bytes to the
+list of blocks that contain it (a 24 bit trigram code, no hashing). A query
+only needs to verify the blocks that contain all of its trigrams.
+
+Segments are saved as soon as they are built, so an interrupted build resumes
+where it stopped. The index of a file is rebuilt when its size or mtime change.
+'''
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+BLOCK_SIZE = 64 * 1024
+
+def index_dir(cache_dir, path):
+    return os.path.join(cache_dir, "index", hashlib.md5(os.path.abspath(path).encode("utf-8")).hexdigest())
+
+def trigrams(data):
+    """Unique 24 bit trigram codes of a bytes object"""
+    if len(data) < 3:
+        return np.zeros(0, dtype=np.uint32)
+    b = np.frombuffer(data, dtype=np.uint8).astype(np.uint32)
+    return np.unique((b[:-2] << 16) | (b[1:-1] << 8) | b[2:])
+
+def _snap(data, pos):
+    """Offset of the line following pos in data"""
+    nl = data.find(b"\n", pos)
+    return len(data) if nl == -1 else nl + 1
+
+def build_segment(path, out_dir, begin, end, first_line, block_size=BLOCK_SIZE):
+    with open(path, "rb") as f:
+        f.seek(begin)
+        data = f.read(end - begin)
+
+    block_offsets = [0]
+    while block_offsets[-1] < len(data):
+        block_offsets.append(_snap(data, block_offsets[-1] + block_size - 1))
+    block_lines = [first_line]
+    for a, b in zip(block_offsets[:-2], block_offsets[1:-1]):
+        block_lines.append(block_lines[-1] + data.count(b"\n", a, b))
+
+    codes = []
+    for i, (a, b) in enumerate(zip(block_offsets[:-1], block_offsets[1:])):
+        lower = data[a:b].decode("utf-8", errors="ignore").lower().encode("utf-8")
+        codes.append((trigrams(lower).astype(np.uint64) << np.uint64(16)) | np.uint64(i))
+
+    pairs = np.sort(np.concatenate(codes)) if len(codes) > 0 else np.zeros(0, dtype=np.uint64)
+    keys = (pairs >> np.uint64(16)).astype(np.uint32)
+    unique_keys, starts = np.unique(keys, return_index=True)
+
+    tmp = out_dir + ".tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    np.save(os.path.join(tmp, "keys.npy"), unique_keys)
+    np.save(os.path.join(tmp, "starts.npy"), np.append(starts, len(keys)).astype(np.uint64))
+    np.save(os.path.join(tmp, "blocks.npy"), (pairs & np.uint64(0xFFFF)).astype(np.uint16))
+    np.save(os.path.join(tmp, "block_offsets.npy"), np.array(block_offsets, dtype=np.uint64) + np.uint64(begin))
+    np.save(os.path.join(tmp, "block_lines.npy"), np.array(block_lines, dtype=np.uint64))
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.rename(tmp, out_dir)
+
+class Segment:
+    def __init__(self, seg_dir):
+        load = lambda name: np.load(os.path.join(seg_dir, name), mmap_mode="r")
+        self.keys = load("keys.npy")
+        self.starts = load("starts.npy")
+        self.blocks = load("blocks.npy")
+        self.block_offsets = load("block_offsets.npy")
+        self.block_lines = load("block_lines.npy")
+
+    def candidates(self, codes):
+        """Blocks containing all of the trigram codes"""
+        result = None
+        for code in codes:
+            i = int(np.searchsorted(self.keys, code))
+            if i >= len(self.keys) or self.keys[i] != code:
+                return []
+            blocks = self.blocks[int(self.starts[i]):int(self.starts[i + 1])]
+            result = np.asarray(blocks) if result is None else np.intersect1d(result, blocks, assume_unique=True)
+            if len(result) == 0:
+                return []
+        if result is None:
+            return range(len(self.block_lines))
+        return result.tolist()
+
+class TrigramIndex:
+    def __init__(self, path, cache_dir, segment_size=SEGMENT_SIZE, block_size=BLOCK_SIZE):
+        self.path = path
+        self.dir = index_dir(cache_dir, path)
+        self.segment_size = segment_size
+        self.block_size = block_size
+
+    def _meta(self):
+        st = os.stat(self.path)
+        return {'path': os.path.abspath(self.path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns,
+                'segment_size': self.segment_size, 'block_size': self.block_size}
+
+    def _segment_ranges(self):
+        """(begin, end, first line) of each segment"""
+        index = lineindex.load(self.path)
+        size = index.size
+        ranges = []
+        begin, line = 0, 0
+        while begin < size:
+            nxt = index.next_line(begin + self.segment_size - 1)
+            end, next_line = (size, None) if nxt is None else (nxt[1], nxt[0])
+            ranges.append((begin, end, line))
+            begin, line = end, next_line
+        return ranges
+
+    def update(self, workers=None):
+        """Build the missing segments of the index"""
+        meta = self._meta()
+        meta_path = os.path.join(self.dir, "meta.json")
+        if os.path.isfile(meta_path):
+            with open(meta_path, "r", encoding="utf-8") as f:
+                if json.loads(f.read()) != meta:
+                    shutil.rmtree(self.dir)
+        os.makedirs(self.dir, exist_ok=True)
+        with open(meta_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps(meta))
+
+        ranges = self._segment_ranges()
+        missing = [(i, r) for i, r in enumerate(ranges) if not os.path.isdir(self._segment_dir(i))]
+        if len(missing) == 0:
+            return
+        print(f"Indexing {self.path} ({len(missing)} of {len(ranges)} segments)")
+
+        if workers is None:
+            workers = os.cpu_count() or 1
+        workers = min(workers, len(missing))
+        if workers > 1 and "fork" in multiprocessing.get_all_start_methods():
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as executor:
+                futures = [executor.submit(build_segment, self.path, self._segment_dir(i), *r, self.block_size) for i, r in missing]
+                for f in futures:
+                    f.result()
+        else:
+            for i, r in missing:
+                build_segment(self.path, self._segment_dir(i), *r, self.block_size)
+
+    def _segment_dir(self, i):
+        return os.path.join(self.dir, f"{i:06d}")
+
+    def segments(self):
+        i = 0
+        while os.path.isdir(self._segment_dir(i)):
+            yield Segment(self._segment_dir(i))
+            i += 1
+
+    def candidate_blocks(self, text):
+        """(first line, bytes) of the blocks that may contain the (lowercase) text"""
+        codes = trigrams(text.encode("utf-8")).tolist()
+        with open(self.path, "rb") as f:
+            for seg in self.segments():
+                for b in seg.candidates(codes):
+                    begin, end = int(seg.block_offsets[b]), int(seg.block_offsets[b + 1])
+                    f.seek(begin)
+                    yield int(seg.block_lines[b]), f.read(end - begin)